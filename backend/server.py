@@ -1,27 +1,373 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pymongo import monitoring, ASCENDING, DESCENDING, GEOSPHERE, IndexModel, UpdateOne, ReplaceOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from typing import List, Optional, Dict, Any, Union
 import os
+import io
+import csv
 import uuid
-from datetime import datetime
+import asyncio
+import base64
+import bisect
+import re
+import time
+import hashlib
+import math
+import importlib
+import threading
+import unicodedata
+import ipaddress
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import json
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+try:
+    import orjson
+except ImportError:  # Optional speed-up; responses fall back to the json module
+    orjson = None
 
 # Environment variables
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.environ.get("DB_NAME", "pharmacy_platform")
 CORS_ORIGINS = os.environ.get("CORS_ORIGINS", "*").split(",")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")  # e.g. a local OpenAI-compatible server
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "20"))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8"))
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", "2048"))
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", "600"))
+CHAT_PROMPT_TOKENS = int(os.environ.get("CHAT_PROMPT_TOKENS", "1500"))  # Approximate budget for stock and history
+CHAT_HISTORY_MESSAGES = int(os.environ.get("CHAT_HISTORY_MESSAGES", "6"))  # Previous exchanges replayed, 0 disables
+CHAT_HISTORY_MINUTES = float(os.environ.get("CHAT_HISTORY_MINUTES", "30"))  # Only exchanges this recent are replayed
+PHARMACY_CACHE_SIZE = int(os.environ.get("PHARMACY_CACHE_SIZE", "1024"))
+PHARMACY_CACHE_TTL = float(os.environ.get("PHARMACY_CACHE_TTL", "300"))
+PHARMACY_CHANGE_STREAM = os.environ.get("PHARMACY_CHANGE_STREAM", "false").lower() == "true"  # Needs a replica set
+CHANGE_STREAM_RETRY_MAX = float(os.environ.get("CHANGE_STREAM_RETRY_MAX", "60"))  # Seconds between reconnects, at most
+STOCK_IMPORT_CHUNK_SIZE = int(os.environ.get("STOCK_IMPORT_CHUNK_SIZE", "1000"))
+STOCK_IMPORT_MAX_ERRORS = 100  # Row errors returned in the import report
+MAINTENANCE_LOCK_TTL_SECONDS = float(os.environ.get("MAINTENANCE_LOCK_TTL_SECONDS", "600"))  # Lease on one-off startup jobs
+PRESCRIPTION_UPLOAD_DIR = os.environ.get("PRESCRIPTION_UPLOAD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "prescriptions"))
+PRESCRIPTION_MAX_BYTES = int(os.environ.get("PRESCRIPTION_MAX_BYTES", str(15 * 1024 * 1024)))
+PRESCRIPTION_WORKERS = int(os.environ.get("PRESCRIPTION_WORKERS", "2"))
+PRESCRIPTION_EXTRACTOR = os.environ.get("PRESCRIPTION_EXTRACTOR")  # "module:function" taking an image path
+GUARD_CACHE_TTL = float(os.environ.get("GUARD_CACHE_TTL", "300"))  # Bounds staleness after imports on other workers
+GUARD_DUTY_MAX_HOURS = 7 * 24
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "100"))  # Per subscriber; events are dropped when full
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get("EVENT_HEARTBEAT_SECONDS", "25"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "200"))
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "0.5"))  # Longest a buffered insert waits
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", "10000"))  # Producers wait beyond this
+SEARCH_MAX_PHARMACIES = int(os.environ.get("SEARCH_MAX_PHARMACIES", "500"))  # Pharmacies loaded per medication search
+# Admission control: requests in flight and waiting per route class, and per-client
+# token buckets (requests per second, burst). Chat gets the smaller budget so LLM
+# traffic cannot starve catalog reads; a rate of 0 disables the limiter.
+API_MAX_CONCURRENCY = int(os.environ.get("API_MAX_CONCURRENCY", "256"))
+API_MAX_QUEUE = int(os.environ.get("API_MAX_QUEUE", "512"))
+API_RATE_LIMIT = float(os.environ.get("API_RATE_LIMIT", "20"))
+API_RATE_BURST = float(os.environ.get("API_RATE_BURST", "40"))
+CHAT_MAX_CONCURRENCY = int(os.environ.get("CHAT_MAX_CONCURRENCY", str(OPENAI_MAX_CONCURRENCY * 2)))
+CHAT_MAX_QUEUE = int(os.environ.get("CHAT_MAX_QUEUE", str(OPENAI_MAX_CONCURRENCY * 2)))
+CHAT_RATE_LIMIT = float(os.environ.get("CHAT_RATE_LIMIT", "0.5"))
+CHAT_RATE_BURST = float(os.environ.get("CHAT_RATE_BURST", "5"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "2"))  # Longest wait for a slot before 503
+ADMISSION_EXEMPT_PATHS = ("/metrics", "/api/events", "/docs", "/redoc", "/openapi.json")
+# Comma-separated IPs/CIDRs of the proxies (ingress, load balancer) allowed to set
+# X-Forwarded-For. Empty when clients connect directly; while unset the per-client
+# rate limits are off, since every request would seem to come from the proxy.
+TRUSTED_PROXIES = os.environ.get("TRUSTED_PROXIES")
+PRESCRIPTION_CONTENT_TYPES = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "application/pdf": ".pdf"}
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms rendered in Prometheus text format"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {}  # name -> (type, help)
+        self._values: Dict[tuple, float] = defaultdict(float)  # (name, labels) -> counter/gauge value
+        self._histograms: Dict[tuple, list] = {}  # (name, labels) -> [bucket counts..., sum, count]
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = [str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs]
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            names = sorted({key[0] for key in self._values} | {key[0] for key in self._histograms})
+            for name in names:
+                kind, help_text = self._meta.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (metric, labels), value in sorted(self._values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for i, bound in enumerate(self.BUCKETS):
+                        lines.append(f"{name}_bucket{self._labels(labels, ('le', bound))} {histogram[i]}")
+                    lines.append(f"{name}_bucket{self._labels(labels, ('le', '+Inf'))} {histogram[-1]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {histogram[-2]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("http_request_duration_seconds", "histogram", "Request latency until the response starts, by route")
+metrics.describe("mongo_command_duration_seconds", "histogram", "MongoDB command round-trip time")
+metrics.describe("mongo_command_failures_total", "counter", "MongoDB commands that failed")
+metrics.describe("validation_duration_seconds", "histogram", "Time spent building Pydantic models from documents")
+metrics.describe("search_documents_examined_total", "counter", "Candidate pharmacies examined by search filters")
+metrics.describe("search_documents_returned_total", "counter", "Results returned by search filters")
+metrics.describe("llm_request_duration_seconds", "histogram", "LLM completion latency")
+metrics.describe("llm_time_to_first_token_seconds", "histogram", "Delay before the first streamed LLM token")
+metrics.describe("llm_tokens_total", "counter", "LLM tokens used")
+metrics.describe("prescription_processing_seconds", "histogram", "Time to extract medications from an uploaded prescription")
+metrics.describe("event_subscribers", "gauge", "Open push-channel subscriptions")
+metrics.describe("events_dropped_total", "counter", "Push events dropped because a subscriber queue was full")
+metrics.describe("cache_entries", "gauge", "Entries held by in-process caches")
+metrics.describe("cache_lookups_total", "counter", "In-process cache lookups by result")
+metrics.describe("write_behind_pending", "gauge", "Documents waiting in a write-behind buffer")
+metrics.describe("write_behind_documents_total", "counter", "Documents flushed by write-behind buffers, by result")
+metrics.describe("admission_in_flight", "gauge", "Admitted requests in flight, by route class")
+metrics.describe("admission_waiting", "gauge", "Requests waiting for an admission slot, by route class")
+metrics.describe("admission_rejected_total", "counter", "Requests rejected by admission control, by reason")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command issued by the client"""
+
+    def __init__(self):
+        self._collections: Dict[tuple, str] = {}
 
-# Initialize OpenAI client
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        metrics.observe("mongo_command_duration_seconds", event.duration_micros / 1e6,
+                        command=event.command_name, collection=collection)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        metrics.observe("mongo_command_duration_seconds", event.duration_micros / 1e6,
+                        command=event.command_name, collection=collection)
+        metrics.inc("mongo_command_failures_total", command=event.command_name, collection=collection)
+
+# Initialize OpenAI client; one async client per worker so its connection pool is shared
 openai_client = None
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    openai_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        timeout=OPENAI_TIMEOUT,
+        max_retries=1
+    )
+
+# Caps in-flight LLM calls so chats queue instead of piling up on the worker
+llm_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+class TokenBucketLimiter:
+    """Per-client token buckets refilled at rate tokens per second up to burst"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: OrderedDict = OrderedDict()  # client -> (tokens, monotonic time of last update)
+
+    def acquire(self, client_id: str) -> float:
+        """Take a token; returns 0 when allowed, else seconds until one is available"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[client_id] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+class AdmissionGate:
+    """Caps the requests of one route class in flight and waiting for a slot
+
+    enter() returns False at once when the wait queue is full, or after timeout
+    seconds without a slot, so overload is answered fast instead of piling up.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, timeout: float):
+        self.name = name
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def enter(self) -> bool:
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            return False
+        self.waiting += 1
+        metrics.set("admission_waiting", self.waiting, route_class=self.name)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+            metrics.set("admission_waiting", self.waiting, route_class=self.name)
+        self.active += 1
+        metrics.set("admission_in_flight", self.active, route_class=self.name)
+        return True
+
+    def leave(self):
+        self.active -= 1
+        metrics.set("admission_in_flight", self.active, route_class=self.name)
+        self._semaphore.release()
+
+admission_gates = {
+    "api": AdmissionGate("api", API_MAX_CONCURRENCY, API_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT),
+    "chat": AdmissionGate("chat", CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT),
+}
+rate_limiters = {
+    "api": TokenBucketLimiter(API_RATE_LIMIT, API_RATE_BURST),
+    "chat": TokenBucketLimiter(CHAT_RATE_LIMIT, CHAT_RATE_BURST),
+}
+
+def parse_trusted_proxies(value: Optional[str]) -> Optional[List[Any]]:
+    if value is None:
+        return None
+    return [ipaddress.ip_network(entry.strip(), strict=False) for entry in value.split(",") if entry.strip()]
+
+trusted_proxy_networks = parse_trusted_proxies(TRUSTED_PROXIES)
+if trusted_proxy_networks is None:
+    print("TRUSTED_PROXIES is not set; per-client rate limits are disabled")
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxy_networks)
+
+def client_address(scope) -> Optional[str]:
+    """Address of the client behind the trusted proxies, or None if it cannot be told
+
+    X-Forwarded-For is read right to left, skipping trusted proxies, and only when
+    the connection itself comes from one; the first other address is the client.
+    """
+    if trusted_proxy_networks is None or not scope.get("client"):
+        return None
+    peer = scope["client"][0]
+    if not is_trusted_proxy(peer):
+        return peer
+    forwarded = []
+    for name, value in scope.get("headers", []):
+        if name == b"x-forwarded-for":
+            forwarded.extend(hop.strip() for hop in value.decode("latin-1").split(","))
+    hops = [hop for hop in forwarded if hop]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
 
 app = FastAPI(title="Pharmacy Platform API", version="1.0.0")
 
+class AdmissionControlMiddleware:
+    """Rate-limit each client and cap concurrency per route class
+
+    Answers 429 with Retry-After when a client exceeds its rate and 503 when the
+    route class is saturated. A plain ASGI middleware, so the slot is held until
+    the response is fully sent (streamed chats count for their whole duration)
+    and released however the request ends. Clients are told apart with
+    client_address, so rate limits need TRUSTED_PROXIES.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or path.startswith(ADMISSION_EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        
+        route_class = "chat" if path.startswith("/api/chat/") else "api"
+        client_id = client_address(scope)
+        retry_after = rate_limiters[route_class].acquire(client_id) if client_id else 0.0
+        if retry_after:
+            metrics.inc("admission_rejected_total", route_class=route_class, reason="rate_limited")
+            response = JSONResponse(
+                {"detail": "Too many requests"}, status_code=429,
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+            await response(scope, receive, send)
+            return
+        
+        gate = admission_gates[route_class]
+        if not await gate.enter():
+            metrics.inc("admission_rejected_total", route_class=route_class, reason="overloaded")
+            response = JSONResponse(
+                {"detail": "Server is busy, please retry shortly"}, status_code=503,
+                headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.leave()
+
+# Added before CORS so rejections still carry CORS headers
+app.add_middleware(AdmissionControlMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -29,10 +375,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.observe(
+        "http_request_duration_seconds", time.perf_counter() - started,
+        method=request.method, route=route.path if route else "unmatched", status=response.status_code
+    )
+    return response
+
 # MongoDB connection
-client = AsyncIOMotorClient(MONGO_URL)
+client = AsyncIOMotorClient(MONGO_URL, event_listeners=[MongoCommandMetrics()])
 db = client[DB_NAME]
 
 # Pydantic models
@@ -70,19 +428,794 @@ class Prescription(BaseModel):
     status: str = "pending"  # pending, processed, ready, delivered
     created_at: datetime = Field(default_factory=datetime.now)
 
+# Prescriptions only move forward through these statuses
+PRESCRIPTION_STATUSES = ["pending", "processed", "ready", "delivered"]
+
+class PrescriptionStatusUpdate(BaseModel):
+    prescription_ids: List[str] = Field(..., min_length=1, max_length=500)
+    status: str
+
+class BasketQuery(BaseModel):
+    medications: List[str] = Field(..., min_length=1, max_length=30)
+    objective: str = Field("fewest_stops", pattern="^(fewest_stops|cheapest)$")
+    lat: Optional[float] = Field(None, ge=-90, le=90)
+    lng: Optional[float] = Field(None, ge=-180, le=180)
+    radius_km: Optional[float] = Field(None, gt=0)
+    wilaya: Optional[str] = None
+    commune: Optional[str] = None
+    candidates: int = Field(50, ge=1, le=200)  # Pharmacies considered, ranked by items covered then distance
+
+def utc_now() -> datetime:
+    """Current time as naive UTC, the clock guard duties are stored and looked up with"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class GuardDuty(BaseModel):
+    pharmacy_id: str
+    starts_at: datetime  # Naive values are taken as UTC
+    ends_at: datetime
+
+    @field_validator("starts_at", "ends_at")
+    @classmethod
+    def to_naive_utc(cls, value: datetime) -> datetime:
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     pharmacy_id: str
     user_id: str
     message: str
     response: Optional[str] = None
+    conversation_id: Optional[str] = None  # Client-generated per chat session; scopes the replayed history
     created_at: datetime = Field(default_factory=datetime.now)
 
+class StockDelta(BaseModel):
+    medication_name: str
+    quantity_delta: int = 0  # Added to the current quantity, negative for sales
+    quantity: Optional[int] = Field(None, ge=0)  # Absolute quantity, overrides quantity_delta
+    price: Optional[float] = Field(None, ge=0)  # Required to give a new medication a price
+
+class PharmacyStockDeltas(BaseModel):
+    pharmacy_id: str
+    deltas: List[StockDelta]
+
+class PharmacySummary(BaseModel):
+    id: str
+    name: str
+    phone: str
+    location: Location
+    is_guard: bool = False
+    has_stock: bool = False  # At least one medication available
+
+class NearbyPharmacy(BaseModel):
+    id: str
+    name: str
+    phone: str
+    location: Location
+    is_guard: bool = False
+    distance_km: float
+    stock: List[PharmacyStock] = []  # Only the items matching the requested medication
+
 class UserQuery(BaseModel):
     medication_name: str
     wilaya: Optional[str] = None
     commune: Optional[str] = None
     quartier: Optional[str] = None
+    lat: Optional[float] = Field(None, ge=-90, le=90)
+    lng: Optional[float] = Field(None, ge=-180, le=180)
+
+# Medication search index
+def normalize_medication_name(name: str) -> str:
+    """Lowercase, accent-free form of a medication name used for matching"""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.lower().split())
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def medication_tokens(name: str) -> List[str]:
+    """Words and numbers of a normalized name, so "doliprane1000mg" gives doliprane, 1000, mg
+
+    Decimal commas become dots, so "2,5mg" and "2.5 mg" share the number 2.5.
+    """
+    return [token.replace(",", ".") for token in re.findall(r"[a-z]+|\d+(?:[.,]\d+)?", name)]
+
+def is_dosage(token: str) -> bool:
+    return token[:1].isdigit()
+
+def medication_dosages(text: str) -> set:
+    """Numbers of a free-text medication name, e.g. {"2.5"} for Bisoprolol 2,5 mg"""
+    return {token for token in medication_tokens(normalize_medication_name(text)) if is_dosage(token)}
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance, or limit + 1 as soon as it is known to exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+# Brand names grouped with their molecule (normalized); a query for any word of a
+# group also matches stock listed under the others.
+MEDICATION_SYNONYMS = {
+    "paracetamol": ["doliprane", "efferalgan", "dafalgan", "panadol", "acetaminophen"],
+    "ibuprofene": ["ibuprofen", "advil", "nurofen", "brufen", "antarene"],
+    "amoxicilline": ["amoxicillin", "clamoxyl", "hiconcil", "augmentin"],
+    "aspirine": ["aspegic", "kardegic"],
+    "diclofenac": ["voltarene", "voltaren"],
+    "phloroglucinol": ["spasfon"],
+    "diosmectite": ["smecta"],
+    "salbutamol": ["ventoline", "ventolin"],
+    "metformine": ["glucophage", "metformin"],
+    "omeprazole": ["mopral"],
+    "esomeprazole": ["inexium", "nexium"],
+    "loratadine": ["clarityne"],
+    "cetirizine": ["zyrtec", "virlix"],
+    "amlodipine": ["amlor"],
+    "levothyroxine": ["levothyrox"],
+}
+MEDICATION_UNITS = {"mg", "g", "mcg", "ug", "ml", "l", "ui", "cp", "cpr", "sachet", "sachets", "gel", "gelule", "gelules"}
+FUZZY_MIN_SCORE = 0.5
+DOSAGE_MISMATCH_PENALTY = 0.02  # Below the synonym discount: a named brand outranks another product's exact dosage
+
+_synonym_groups: Dict[str, set] = {}
+for _molecule, _brands in MEDICATION_SYNONYMS.items():
+    _group = {_molecule, *_brands}
+    for _word in _group:
+        _synonym_groups[_word] = _group
+_synonym_trigrams: Dict[str, set] = defaultdict(set)
+for _word in _synonym_groups:
+    for _gram in _trigrams(_word):
+        _synonym_trigrams[_gram].add(_word)
+
+class MedicationIndex:
+    """In-process trigram index of available medications, kept in sync with stock writes"""
+
+    def __init__(self):
+        self._postings: Dict[str, set] = defaultdict(set)  # normalized name -> pharmacy ids
+        self._trigrams: Dict[str, set] = defaultdict(set)  # trigram -> normalized names
+        self._words: Dict[str, set] = defaultdict(set)     # word -> normalized names
+        self._word_trigrams: Dict[str, set] = defaultdict(set)  # trigram -> words
+        self._sorted_words: List[str] = []
+        self._by_pharmacy: Dict[str, set] = {}             # pharmacy id -> normalized names
+        self._spellings: Dict[str, set] = defaultdict(set)  # normalized name -> stored names
+
+    def clear(self):
+        self.__init__()
+
+    def replace_pharmacy(self, pharmacy_id: str, stock: List[Dict[str, Any]]):
+        """Re-index the available stock of one pharmacy"""
+        self.remove_pharmacy(pharmacy_id)
+        names = set()
+        for item in stock:
+            name = normalize_medication_name(item.get("medication_name", ""))
+            if not name or not item.get("available", False):
+                continue
+            if name not in self._postings:
+                self._add_name(name)
+            self._postings[name].add(pharmacy_id)
+            self._spellings[name].add(item["medication_name"])
+            names.add(name)
+        self._by_pharmacy[pharmacy_id] = names
+
+    def remove_pharmacy(self, pharmacy_id: str):
+        for name in self._by_pharmacy.pop(pharmacy_id, set()):
+            postings = self._postings.get(name)
+            if postings is None:
+                continue
+            postings.discard(pharmacy_id)
+            if not postings:
+                self._remove_name(name)
+
+    def _add_name(self, name: str):
+        for gram in _trigrams(name):
+            self._trigrams[gram].add(name)
+        for word in medication_tokens(name):
+            if word not in self._words:
+                bisect.insort(self._sorted_words, word)
+                for gram in _trigrams(word):
+                    self._word_trigrams[gram].add(word)
+            self._words[word].add(name)
+
+    def _remove_name(self, name: str):
+        del self._postings[name]
+        self._spellings.pop(name, None)
+        for gram in _trigrams(name):
+            names = self._trigrams.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._trigrams[gram]
+        for word in medication_tokens(name):
+            names = self._words.get(word)
+            if names is None:
+                continue
+            names.discard(name)
+            if not names:
+                del self._words[word]
+                for gram in _trigrams(word):
+                    words = self._word_trigrams.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self._word_trigrams[gram]
+                position = bisect.bisect_left(self._sorted_words, word)
+                if position < len(self._sorted_words) and self._sorted_words[position] == word:
+                    self._sorted_words.pop(position)
+
+    def match_names(self, query: str) -> set:
+        """Normalized medication names containing the query (prefix match on words for 1-2 chars)"""
+        needle = normalize_medication_name(query)
+        if not needle:
+            return set()
+        if len(needle) < 3:
+            names = set()
+            position = bisect.bisect_left(self._sorted_words, needle)
+            while position < len(self._sorted_words) and self._sorted_words[position].startswith(needle):
+                names |= self._words[self._sorted_words[position]]
+                position += 1
+            return names
+        candidates = None
+        for gram in sorted(_trigrams(needle), key=lambda g: len(self._trigrams.get(g, ()))):
+            names = self._trigrams.get(gram)
+            if not names:
+                return set()
+            candidates = set(names) if candidates is None else candidates & names
+            if not candidates:
+                return set()
+        return {name for name in candidates if needle in name}
+
+    def similar_words(self, word: str) -> Dict[str, float]:
+        """Indexed words close to a query word, scored in (0, 1]
+
+        Exact words score 1, prefixes 0.9, infixes 0.8 and typos by edit distance;
+        brand/molecule synonyms of a match score slightly below it.
+        """
+        if is_dosage(word) or len(word) < 3:
+            matches = {}
+            position = bisect.bisect_left(self._sorted_words, word)
+            while position < len(self._sorted_words) and self._sorted_words[position].startswith(word):
+                candidate = self._sorted_words[position]
+                matches[candidate] = 1.0 if candidate == word else 0.9
+                position += 1
+            if is_dosage(word):
+                return {candidate: score for candidate, score in matches.items() if score == 1.0}
+            return matches
+        
+        grams = _trigrams(word)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self._word_trigrams.get(gram, ()):
+                shared[candidate] += 1
+            for candidate in _synonym_trigrams.get(gram, ()):
+                shared[candidate] += 1
+        
+        limit = 1 if len(word) < 6 else 2
+        # Each edit destroys at most three trigrams, so closer words share at least this many
+        min_shared = max(1, len(grams) - 3 * limit)
+        scored = {}
+        for candidate, count in shared.items():
+            if candidate == word:
+                score = 1.0
+            elif candidate.startswith(word):
+                score = 0.9
+            elif word in candidate:
+                score = 0.8
+            elif count < min_shared:
+                continue
+            else:
+                distance = edit_distance(word, candidate, limit)
+                if distance > limit:
+                    continue
+                score = 0.85 * (1 - distance / max(len(word), len(candidate)))
+            scored[candidate] = max(score, scored.get(candidate, 0.0))
+        
+        matches = {}
+        for candidate, score in scored.items():
+            for synonym in _synonym_groups.get(candidate, {candidate}):
+                synonym_score = score if synonym == candidate else score * 0.95
+                if synonym in self._words and synonym_score > matches.get(synonym, 0.0):
+                    matches[synonym] = synonym_score
+        return matches
+    
+    def search_names(self, query: str) -> Dict[str, float]:
+        """Normalized medication names matching a free-text query, with a relevance score
+
+        Every query word is matched fuzzily and units are ignored. Numbers (dosages)
+        only order names of equal relevance: a name lacking some of them loses up to
+        DOSAGE_MISMATCH_PENALTY, so a different dosage still matches but ranks
+        lower. A query made only of numbers matches them exactly.
+        """
+        words = [word for word in medication_tokens(normalize_medication_name(query)) if word not in MEDICATION_UNITS]
+        if not words:
+            return {}
+        terms = [word for word in words if not is_dosage(word)]
+        dosages = [word for word in words if is_dosage(word)]
+        if not terms:
+            terms, dosages = dosages, []
+        totals = defaultdict(float)
+        for word in terms:
+            best = {}
+            for match, score in self.similar_words(word).items():
+                for name in self._words[match]:
+                    if score > best.get(name, 0.0):
+                        best[name] = score
+            for name, score in best.items():
+                totals[name] += score
+        scores = {}
+        for name, total in totals.items():
+            score = total / len(terms)
+            # Dosages only rank the candidates found by the words
+            if dosages:
+                missing = sum(1 for dosage in dosages if name not in self._words.get(dosage, ()))
+                score -= DOSAGE_MISMATCH_PENALTY * missing / len(dosages)
+            if score >= FUZZY_MIN_SCORE:
+                scores[name] = round(score, 3)
+        return scores
+    
+    def pharmacy_ids(self, names: set) -> set:
+        ids = set()
+        for name in names:
+            ids |= self._postings.get(name, set())
+        return ids
+
+    def best_scores(self, scores: Dict[str, float]) -> Dict[str, float]:
+        """Pharmacy id -> best score among the scored names it has available"""
+        best = {}
+        for name, score in scores.items():
+            for pharmacy_id in self._postings.get(name, ()):
+                if score > best.get(pharmacy_id, 0.0):
+                    best[pharmacy_id] = score
+        return best
+
+    def spellings(self, names) -> List[str]:
+        """Stored medication_name values that normalize to the given names"""
+        return sorted({spelling for name in names for spelling in self._spellings.get(name, ())})
+
+    def available_names(self, pharmacy_id: str) -> set:
+        return set(self._by_pharmacy.get(pharmacy_id, ()))
+
+    def has_available_stock(self, pharmacy_id: str) -> bool:
+        return bool(self._by_pharmacy.get(pharmacy_id))
+
+    def rank_names(self, text: str, ignore: set = frozenset()) -> Dict[str, float]:
+        """Names sharing words with free text such as a chat question, scored by the words they match
+
+        Unlike search_names, names need not match every word; numbers only add to
+        names already matched by a word.
+        """
+        words = set(medication_tokens(normalize_medication_name(text))) - MEDICATION_UNITS - ignore
+        totals = defaultdict(float)
+        for word in words:
+            if is_dosage(word) or len(word) < 3:
+                continue
+            best = {}
+            for match, score in self.similar_words(word).items():
+                for name in self._words[match]:
+                    if score > best.get(name, 0.0):
+                        best[name] = score
+            for name, score in best.items():
+                totals[name] += score
+        for word in words:
+            if is_dosage(word):
+                names = self._words.get(word, ())
+                for name in totals:
+                    if name in names:
+                        totals[name] += 0.5
+        return dict(totals)
+    
+    def lookup(self, query: str) -> set:
+        """Ids of pharmacies with an available medication matching the query"""
+        return self.pharmacy_ids(self.search_names(query))
+
+medication_index = MedicationIndex()
+
+async def rebuild_medication_index():
+    """Load every pharmacy's stock names into the medication index"""
+    medication_index.clear()
+    projection = {"_id": 0, "id": 1, "stock.medication_name": 1, "stock.available": 1}
+    async for pharmacy in db.pharmacies.find({}, projection):
+        medication_index.replace_pharmacy(pharmacy["id"], pharmacy.get("stock", []))
+
+# Location fields are listed one by one so the stored location.geo point is not fetched
+LOCATION_PROJECTION = {f"location.{field}": 1 for field in Location.__fields__}
+PHARMACY_SUMMARY_PROJECTION = {"_id": 0, "id": 1, "name": 1, "phone": 1, "is_guard": 1, **LOCATION_PROJECTION}
+PHARMACY_PROJECTION = {
+    "_id": 0,
+    **{field: 1 for field in Pharmacy.__fields__ if field != "location"},
+    **LOCATION_PROJECTION
+}
+
+SEARCH_PHARMACY_PROJECTION = {field: value for field, value in PHARMACY_PROJECTION.items() if field != "stock"}
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, BaseModel):
+        return value.dict()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+class LeanJSONResponse(JSONResponse):
+    """JSON response for documents that were validated when written
+
+    Skips FastAPI's response_model re-validation and jsonable_encoder walk: the
+    content (dicts, lists, datetimes) is encoded in one pass, with orjson when
+    it is installed.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, default=_json_default)
+        return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    """Opaque keyset cursor holding the sort key of the last item of a page"""
+    return base64.urlsafe_b64encode(json.dumps(position, default=str).encode()).decode()
+
+def decode_cursor(cursor: str, *fields: str) -> Dict[str, Any]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {field: position[field] for field in fields}
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+class LRUCache:
+    """Size-bounded LRU cache with per-entry TTL and hit/miss counters"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+# Chat answers keyed by (pharmacy id, stock hash, normalized question)
+chat_cache = LRUCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+
+def stock_version(pharmacy: "Pharmacy") -> str:
+    """Hash of a pharmacy's stock; changes whenever the stock does"""
+    payload = json.dumps([item.dict() for item in pharmacy.stock], sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def normalize_question(message: str) -> str:
+    return re.sub(r"[^\w]+", " ", normalize_medication_name(message)).strip()
+
+def chat_cache_key(pharmacy: "Pharmacy", message: str) -> tuple:
+    return (pharmacy.id, pharmacy_prompt(pharmacy).version, normalize_question(message))
+
+# Validated Pharmacy objects for hot reads, invalidated on every write
+pharmacy_cache = LRUCache(PHARMACY_CACHE_SIZE, PHARMACY_CACHE_TTL)
+
+class WriteBehindBuffer:
+    """Coalesces inserts into one collection into insert_many batches
+
+    A batch is written once batch_size documents are pending or every interval
+    seconds. add() waits for a flush while max_pending documents are queued; with
+    wait=True it returns only once the document is written and raises if it was
+    not. Batches that fail on connection errors, or whose write is cancelled, are
+    kept for the next flush; stop() ends run() after a last flush.
+    """
+
+    def __init__(self, collection: str, batch_size: int, interval: float, max_pending: int):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: List[tuple] = []  # (document, future of a waiting caller or None)
+        self._in_flight: List[tuple] = []  # Batch being written
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending(self, predicate) -> List[Dict[str, Any]]:
+        """Queued or in-flight documents matching predicate, for read-your-writes lookups"""
+        return [document for document, _ in self._in_flight + self._pending if predicate(document)]
+
+    async def add(self, document: Dict[str, Any], wait: bool = False):
+        while len(self._pending) >= self.max_pending:
+            if not await self.flush():
+                await asyncio.sleep(self.interval)
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._pending.append((document, future))
+        metrics.set("write_behind_pending", len(self._pending), collection=self.collection)
+        if future is not None:
+            # Flush right away; concurrent waiters end up sharing the batch
+            await self.flush()
+            await future
+        elif len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def run(self):
+        """Flush loop, run as a background task until stop()"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._stopping:
+                return
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """Write everything pending; False if a batch had to be kept for later"""
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                self._in_flight = batch
+                failed = set()
+                error = None
+                try:
+                    await db[self.collection].insert_many([document for document, _ in batch], ordered=False)
+                except BulkWriteError as e:
+                    # Rejected documents would fail again; the rest were written. A duplicate
+                    # key means the document was written by an earlier, interrupted attempt.
+                    failed = {
+                        write_error["index"] for write_error in e.details.get("writeErrors", [])
+                        if write_error.get("code") != 11000
+                    }
+                    error = e if failed else None
+                except asyncio.CancelledError:
+                    # The outcome is unknown: keep the whole batch, waiters included, for the next flush
+                    self._pending[:0] = batch
+                    raise
+                except Exception as e:
+                    error = e
+                    failed = set(range(len(batch)))
+                    self._pending[:0] = [(document, None) for document, future in batch if future is None]
+                finally:
+                    self._in_flight = []
+                
+                if error:
+                    print(f"Write-behind insert into {self.collection} failed: {error}")
+                metrics.inc("write_behind_documents_total", len(batch) - len(failed), collection=self.collection, result="written")
+                metrics.inc("write_behind_documents_total", len(failed), collection=self.collection, result="failed")
+                metrics.set("write_behind_pending", len(self._pending), collection=self.collection)
+                for position, (_, future) in enumerate(batch):
+                    if future is not None and not future.done():
+                        if position in failed:
+                            future.set_exception(error)
+                        else:
+                            future.set_result(None)
+                if error and not isinstance(error, BulkWriteError):
+                    return False
+        return True
+
+chat_message_writer = WriteBehindBuffer("chat_messages", WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_PENDING)
+prescription_writer = WriteBehindBuffer("prescriptions", WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_PENDING)
+WRITE_BEHIND_BUFFERS = [chat_message_writer, prescription_writer]
+
+class EventBus:
+    """Fans events out to push subscribers scoped by pharmacy, user or medication
+
+    Each subscriber is a bounded queue registered under its scopes, so publishing
+    only touches the queues of interested subscribers and idle ones cost nothing.
+    """
+
+    def __init__(self):
+        self._pharmacies: Dict[str, set] = defaultdict(set)   # pharmacy id -> queues
+        self._users: Dict[str, set] = defaultdict(set)        # user id -> queues
+        self._medications: Dict[str, set] = defaultdict(set)  # normalized medication name or word -> queues
+        self.subscribers = 0
+        self.dropped = 0
+
+    def subscribe(self, pharmacy_ids: List[str], user_ids: List[str], medications: List[str]) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        queue.scopes = (
+            [(self._pharmacies, key) for key in pharmacy_ids]
+            + [(self._users, key) for key in user_ids]
+            + [(self._medications, normalize_medication_name(key)) for key in medications]
+        )
+        for registry, key in queue.scopes:
+            registry[key].add(queue)
+        self.subscribers += 1
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        for registry, key in queue.scopes:
+            queues = registry.get(key)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del registry[key]
+        self.subscribers -= 1
+
+    def has_user_subscribers(self) -> bool:
+        return bool(self._users)
+
+    def _deliver(self, queues, event: str, data: Dict[str, Any]):
+        for queue in list(queues):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    def publish_pharmacy(self, pharmacy_id: str, event: str, data: Dict[str, Any]):
+        self._deliver(self._pharmacies.get(pharmacy_id, ()), event, data)
+
+    def publish_user(self, user_id: str, event: str, data: Dict[str, Any]):
+        self._deliver(self._users.get(user_id, ()), event, data)
+
+    def publish_medication(self, medication: str, event: str, data: Dict[str, Any]):
+        """Deliver to subscribers of the normalized name or of one of its words"""
+        queues = set()
+        for key in {medication, *medication_tokens(medication)}:
+            queues |= self._medications.get(key, set())
+        self._deliver(queues, event, data)
+
+event_bus = EventBus()
+
+def geo_point(location: Dict[str, Any]) -> Dict[str, Any]:
+    """GeoJSON point for a pharmacy location, stored as location.geo"""
+    return {"type": "Point", "coordinates": [location["lng"], location["lat"]]}
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * 6371.0088 * math.asin(math.sqrt(a))
+
+# Indexes applied at startup; create_indexes is a no-op for indexes that already exist
+INDEXES = {
+    "pharmacies": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("location.wilaya", ASCENDING), ("location.commune", ASCENDING), ("location.quartier", ASCENDING)]),
+        IndexModel([("subscription_active", ASCENDING), ("location.wilaya", ASCENDING), ("location.commune", ASCENDING)]),
+        # Pages of one commune or quartier, whatever the wilaya
+        IndexModel([("location.commune", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("location.quartier", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("location.geo", GEOSPHERE)]),
+    ],
+    "prescriptions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("pharmacy_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("pharmacy_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Only pending uploads are indexed, for the startup re-queue
+        IndexModel([("status", ASCENDING), ("image_path", ASCENDING)], partialFilterExpression={"status": "pending"}),
+    ],
+    "chat_messages": [
+        IndexModel([("pharmacy_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("pharmacy_id", ASCENDING), ("conversation_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "guard_duties": [
+        IndexModel([("pharmacy_id", ASCENDING), ("starts_at", ASCENDING)], unique=True),
+        IndexModel([("buckets", ASCENDING), ("wilaya", ASCENDING), ("commune", ASCENDING)]),
+    ],
+    "medication_offers": [
+        IndexModel([("pharmacy_id", ASCENDING), ("medication", ASCENDING)], unique=True),
+        IndexModel([("wilaya", ASCENDING), ("commune", ASCENDING), ("medication", ASCENDING)]),
+    ],
+    "medication_availability": [
+        IndexModel([("medication", ASCENDING), ("wilaya", ASCENDING), ("commune", ASCENDING)], unique=True),
+    ],
+    "medication_offer_revisions": [
+        IndexModel([("pharmacy_id", ASCENDING)], unique=True),
+    ],
+}
+
+# Query shapes issued by this module, checked by /api/diagnostics/query-plans:
+# (name, collection, filter, sort)
+QUERY_SHAPES = [
+    ("get_pharmacy", "pharmacies", {"id": "x"}, None),
+    ("list_pharmacies", "pharmacies", {}, [("id", ASCENDING)]),
+    ("list_pharmacies_by_wilaya", "pharmacies", {"location.wilaya": "x"}, [("id", ASCENDING)]),
+    ("list_pharmacies_by_commune", "pharmacies", {"location.wilaya": "x", "location.commune": "x"}, [("id", ASCENDING)]),
+    ("list_pharmacies_by_commune_only", "pharmacies", {"location.commune": "x"}, [("id", ASCENDING)]),
+    ("list_pharmacies_by_quartier", "pharmacies", {"location.quartier": "x"}, [("id", ASCENDING)]),
+    ("list_pharmacies_by_medication", "pharmacies", {"id": {"$in": ["x"]}}, [("id", ASCENDING)]),
+    ("search_medication", "pharmacies", {"subscription_active": True, "id": {"$in": ["x"]}}, None),
+    ("search_medication_in_wilaya", "pharmacies", {"subscription_active": True, "location.wilaya": "x", "id": {"$in": ["x"]}}, None),
+    ("import_stock_item", "pharmacies", {"id": "x", "stock.medication_name": "x"}, None),
+    ("user_prescriptions", "prescriptions", {"user_id": "x"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("user_prescriptions_by_status", "prescriptions", {"user_id": "x", "status": "x"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("pharmacy_prescriptions", "prescriptions", {"pharmacy_id": "x"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("pharmacy_prescriptions_by_status", "prescriptions", {"pharmacy_id": "x", "status": "x"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("prescription_by_id", "prescriptions", {"id": "x"}, None),
+    ("process_prescription", "prescriptions", {"id": "x", "status": "pending"}, None),
+    ("prescription_status_update", "prescriptions", {"pharmacy_id": "x", "id": {"$in": ["x"]}, "status": {"$in": ["x"]}}, None),
+    ("prescription_status_notify", "prescriptions", {"pharmacy_id": "x", "id": {"$in": ["x"]}, "updated_at": "x"}, None),
+    ("pending_uploads", "prescriptions", {"status": "pending", "image_path": {"$exists": True}, "processing_error": {"$exists": False}}, None),
+    ("pharmacy_chat_messages", "chat_messages", {"pharmacy_id": "x"}, None),
+    ("chat_history", "chat_messages", {"pharmacy_id": "x", "conversation_id": "x", "created_at": {"$gte": "x"}}, [("created_at", DESCENDING)]),
+    ("guard_duties_now", "guard_duties", {"buckets": "x"}, None),
+    ("guard_duties_now_in_commune", "guard_duties", {"buckets": "x", "wilaya": "x", "commune": "x"}, None),
+    ("guard_duty_upsert", "guard_duties", {"pharmacy_id": "x", "starts_at": "x"}, None),
+    ("pharmacy_offers", "medication_offers", {"pharmacy_id": {"$in": ["x"]}}, None),
+    ("offer_upsert", "medication_offers", {"pharmacy_id": "x", "medication": "x", "revision": {"$not": {"$gte": 1}}}, None),
+    ("regional_offers", "medication_offers", {"$or": [{"wilaya": "x", "commune": "x", "medication": {"$in": ["x"]}}], "available": {"$ne": False}}, None),
+    ("offer_watermarks", "medication_offer_revisions", {"pharmacy_id": {"$in": ["x"]}}, None),
+    ("offer_watermark_update", "medication_offer_revisions", {"pharmacy_id": "x", "revision": {"$lt": 1}}, None),
+    ("medication_availability", "medication_availability", {"medication": {"$in": ["x"]}}, [("min_price", ASCENDING)]),
+    ("medication_availability_in_wilaya", "medication_availability", {"medication": {"$in": ["x"]}, "wilaya": "x"}, [("min_price", ASCENDING)]),
+    ("medication_availability_in_commune", "medication_availability", {"medication": {"$in": ["x"]}, "wilaya": "x", "commune": "x"}, [("min_price", ASCENDING)]),
+    ("availability_upsert", "medication_availability", {"medication": "x", "wilaya": "x", "commune": "x"}, None),
+    ("maintenance_lock", "maintenance_locks", {"_id": "x", "expires_at": {"$lt": "x"}}, None),
+]
+
+async def ensure_indexes():
+    """Create every declared index; safe to run on each startup"""
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except Exception as e:
+            print(f"Error creating indexes on {collection}: {e}")
+
+def plan_stages(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Flatten the stages of an explain() plan tree"""
+    stages = [plan] if "stage" in plan else []
+    for key in ("queryPlan", "inputStage"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+def is_unbounded_scan(stage: Dict[str, Any]) -> bool:
+    """Whether an index scan reads the whole index, e.g. the id index picked only for its sort"""
+    bounds = stage.get("indexBounds")
+    if stage["stage"] != "IXSCAN" or not bounds:
+        return False
+    return all(ranges in (["[MinKey, MaxKey]"], ["[MaxKey, MinKey]"]) for ranges in bounds.values())
 
 # Sample data for Algeria locations
 ALGERIA_PHARMACIES = [
@@ -138,6 +1271,97 @@ ALGERIA_PHARMACIES = [
     }
 ]
 
+# Prescription processing queue
+DOSAGE_PATTERN = re.compile(r"\d+(?:[.,]\d+)?\s*(?:mg|g|ml|mcg|µg|ui|%)\b", re.IGNORECASE)
+
+def extract_medications_with_ocr(image_path: str) -> List[str]:
+    """Default extractor: OCR the image and keep the lines that carry a dosage
+
+    Needs the optional pytesseract and Pillow packages; without them nothing is
+    extracted and the prescription keeps the medications submitted with it.
+    """
+    try:
+        import pytesseract
+        from PIL import Image
+    except ImportError:
+        return []
+    if image_path.endswith(".pdf"):
+        return []
+    with Image.open(image_path) as image:
+        text = pytesseract.image_to_string(image, lang="fra")
+    return [" ".join(line.split()) for line in text.splitlines() if DOSAGE_PATTERN.search(line)]
+
+def load_prescription_extractor():
+    if PRESCRIPTION_EXTRACTOR:
+        module_name, _, function_name = PRESCRIPTION_EXTRACTOR.partition(":")
+        return getattr(importlib.import_module(module_name), function_name)
+    return extract_medications_with_ocr
+
+prescription_extractor = load_prescription_extractor()
+prescription_queue: asyncio.Queue = asyncio.Queue()
+
+def publish_prescription_status(prescription: Dict[str, Any], status: str, from_change_stream: bool = False):
+    """Push a status change to the user's and the pharmacy's subscribers
+
+    Subscribers may be connected to another worker, so with PHARMACY_CHANGE_STREAM
+    every worker publishes from the prescriptions change stream instead, and the
+    writer's own call is skipped. Without it, only this worker's subscribers are
+    notified.
+    """
+    if PHARMACY_CHANGE_STREAM and not from_change_stream:
+        return
+    data = {"prescription_id": prescription["id"], "pharmacy_id": prescription["pharmacy_id"], "status": status}
+    event_bus.publish_user(prescription["user_id"], "prescription", data)
+    event_bus.publish_pharmacy(prescription["pharmacy_id"], "prescription", data)
+
+async def process_prescription(prescription_id: str):
+    """Extract medications from an uploaded image and move the prescription to processed"""
+    prescription = await db.prescriptions.find_one(
+        {"id": prescription_id, "status": "pending"},
+        {"_id": 0, "id": 1, "user_id": 1, "pharmacy_id": 1, "image_path": 1, "medications": 1}
+    )
+    if not prescription or not prescription.get("image_path"):
+        return
+    # Extraction is blocking (OCR), so it runs off the event loop
+    extracted = await asyncio.to_thread(prescription_extractor, prescription["image_path"])
+    medications = list(dict.fromkeys(prescription.get("medications", []) + list(extracted)))
+    result = await db.prescriptions.update_one(
+        {"id": prescription_id, "status": "pending"},
+        {"$set": {"medications": medications, "status": "processed", "processed_at": datetime.now()}}
+    )
+    if result.modified_count:
+        publish_prescription_status(prescription, "processed")
+
+async def prescription_worker():
+    while True:
+        prescription_id = await prescription_queue.get()
+        try:
+            with metrics.time("prescription_processing_seconds"):
+                await process_prescription(prescription_id)
+        except Exception as e:
+            print(f"Error processing prescription {prescription_id}: {e}")
+            await db.prescriptions.update_one({"id": prescription_id}, {"$set": {"processing_error": str(e)}})
+        finally:
+            prescription_queue.task_done()
+
+async def save_request_body(request: Request, path: str) -> int:
+    """Stream the request body to a file chunk by chunk; returns the size written"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = path + ".part"
+    size = 0
+    try:
+        with open(partial_path, "wb") as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > PRESCRIPTION_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Prescription image too large")
+                await asyncio.to_thread(f.write, chunk)
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return size
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize database with sample data"""
@@ -146,25 +1370,184 @@ async def startup_event():
         pharmacy_count = await db.pharmacies.count_documents({})
         if pharmacy_count == 0:
             # Insert sample pharmacies
-            await db.pharmacies.insert_many(ALGERIA_PHARMACIES)
+            # Validated like any other write, so reads can serve the documents as stored
+            documents = []
+            for pharmacy in ALGERIA_PHARMACIES:
+                document = Pharmacy(**pharmacy).dict()
+                document["location"]["geo"] = geo_point(document["location"])
+                documents.append(document)
+            await db.pharmacies.insert_many(documents)
             print(f"Inserted {len(ALGERIA_PHARMACIES)} sample pharmacies")
+        # Backfill GeoJSON points for pharmacies stored before location.geo existed
+        await db.pharmacies.update_many(
+            {"location.geo": {"$exists": False}},
+            [{"$set": {"location.geo": {
+                "type": "Point",
+                "coordinates": ["$location.lng", "$location.lat"]
+            }}}]
+        )
+        await ensure_indexes()
+        await rebuild_medication_index()
+        pharmacy_cache.clear()
     except Exception as e:
         print(f"Error initializing database: {e}")
+    try:
+        # Every worker starts with the same empty aggregate; only the one holding the lock rebuilds it
+        if await db.medication_availability.estimated_document_count() == 0:
+            if await acquire_maintenance_lock("medication_availability"):
+                try:
+                    await rebuild_medication_availability()
+                finally:
+                    await release_maintenance_lock("medication_availability")
+    except Exception as e:
+        print(f"Error rebuilding medication availability: {e}")
+    
+    if PHARMACY_CHANGE_STREAM:
+        app.state.change_watchers = [
+            asyncio.create_task(watch_pharmacy_changes()),
+            asyncio.create_task(watch_prescription_changes())
+        ]
+    
+    app.state.prescription_workers = [asyncio.create_task(prescription_worker()) for _ in range(PRESCRIPTION_WORKERS)]
+    app.state.write_behind_flushers = [asyncio.create_task(buffer.run()) for buffer in WRITE_BEHIND_BUFFERS]
+    try:
+        # Resume uploads that were not processed before the last shutdown; ones that
+        # already failed are left for a manual retry rather than failing on every start
+        async for prescription in db.prescriptions.find(
+            {"status": "pending", "image_path": {"$exists": True}, "processing_error": {"$exists": False}},
+            {"_id": 0, "id": 1}
+        ):
+            prescription_queue.put_nowait(prescription["id"])
+    except Exception as e:
+        print(f"Error queueing pending prescriptions: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Write buffered inserts and release pooled connections"""
+    for watcher in getattr(app.state, "change_watchers", []):
+        watcher.cancel()
+    for worker in getattr(app.state, "prescription_workers", []):
+        worker.cancel()
+    # Flushers finish the batch they are writing and flush once more before exiting
+    for buffer in WRITE_BEHIND_BUFFERS:
+        buffer.stop()
+    await asyncio.gather(*getattr(app.state, "write_behind_flushers", []), return_exceptions=True)
+    for buffer in WRITE_BEHIND_BUFFERS:
+        if not await buffer.flush():
+            print(f"Lost {len(buffer)} buffered {buffer.collection} documents at shutdown")
+    if openai_client:
+        await openai_client.close()
+    client.close()
 
 # API Routes
 @app.get("/")
 async def root():
     return {"message": "Pharmacy Platform API", "version": "1.0.0"}
 
-@app.get("/api/pharmacies", response_model=List[Pharmacy])
+async def load_pharmacy(pharmacy_id: str) -> Optional[Pharmacy]:
+    """Get a validated pharmacy, from the hot-read cache when possible"""
+    pharmacy = pharmacy_cache.get(pharmacy_id)
+    if pharmacy is None:
+        document = await db.pharmacies.find_one({"id": pharmacy_id})
+        if not document:
+            return None
+        with metrics.time("validation_duration_seconds", model="Pharmacy"):
+            pharmacy = Pharmacy(**document)
+        pharmacy_cache.set(pharmacy_id, pharmacy)
+    return pharmacy
+
+# Change stream errors meaning the resume token can no longer be used
+CHANGE_STREAM_HISTORY_LOST = {136, 280, 286}
+
+async def follow_change_stream(name: str, collection, handle, on_reset=None, pipeline=None, **options):
+    """Apply a collection's change stream until cancelled
+
+    The stream is reopened after errors with exponential backoff, resuming after
+    the last handled change. If that point has left the oplog, the stream starts
+    over from now and on_reset is awaited to resync whatever was missed.
+    """
+    resume_token = None
+    delay = 1.0
+    while True:
+        try:
+            async with collection.watch(pipeline, resume_after=resume_token, **options) as stream:
+                delay = 1.0
+                async for change in stream:
+                    handle(change)
+                    resume_token = stream.resume_token
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, OperationFailure) and e.code in CHANGE_STREAM_HISTORY_LOST and resume_token is not None:
+                print(f"{name} change stream cannot resume, restarting from now: {e}")
+                resume_token = None
+                if on_reset:
+                    try:
+                        await on_reset()
+                    except Exception as reset_error:
+                        print(f"Error resyncing after the {name} change stream restarted: {reset_error}")
+                continue
+            print(f"{name} change stream stopped, retrying in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CHANGE_STREAM_RETRY_MAX)
+
+def apply_pharmacy_change(change: Dict[str, Any]):
+    document = change.get("fullDocument")
+    if document:
+        refresh_local_pharmacy_state(document["id"], document.get("stock", []))
+    else:
+        # Deletes only carry the _id, so drop everything cached
+        pharmacy_cache.clear()
+        chat_cache.clear()
+
+async def resync_pharmacies():
+    await rebuild_medication_index()
+    pharmacy_cache.clear()
+    chat_cache.clear()
+    prompt_cache.clear()
+
+def apply_prescription_change(change: Dict[str, Any]):
+    document = change.get("fullDocument")
+    if document:
+        publish_prescription_status(
+            document, change["updateDescription"]["updatedFields"]["status"], from_change_stream=True
+        )
+
+async def watch_pharmacy_changes():
+    """Follow the pharmacies change stream so writes from other workers refresh this one"""
+    await follow_change_stream(
+        "Pharmacy", db.pharmacies, apply_pharmacy_change,
+        on_reset=resync_pharmacies, full_document="updateLookup"
+    )
+
+async def watch_prescription_changes():
+    """Follow prescription status changes so every worker notifies its own subscribers
+
+    Events missed while the stream was down are not replayed.
+    """
+    pipeline = [{"$match": {"operationType": "update", "updateDescription.updatedFields.status": {"$exists": True}}}]
+    await follow_change_stream(
+        "Prescription", db.prescriptions, apply_prescription_change,
+        pipeline=pipeline, full_document="updateLookup"
+    )
+
+@app.get("/api/pharmacies", response_model=List[Union[Pharmacy, PharmacySummary]])
 async def get_pharmacies(
     wilaya: Optional[str] = None,
     commune: Optional[str] = None,
     quartier: Optional[str] = None,
-    medication: Optional[str] = None
+    medication: Optional[str] = None,
+    summary: bool = False,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None
 ):
-    """Get pharmacies with optional filtering"""
+    """Get a page of pharmacies with optional filtering
+
+    Pages are ordered by id; the cursor for the next page is returned in the
+    X-Next-Cursor header. With summary=true the stock array is left out.
+    """
     query = {}
+    id_filter = {}
     
     if wilaya:
         query["location.wilaya"] = wilaya
@@ -173,43 +1556,610 @@ async def get_pharmacies(
     if quartier:
         query["location.quartier"] = quartier
     
-    pharmacies = await db.pharmacies.find(query).to_list(length=None)
+    # Filter by medication availability through the medication index
+    if medication:
+        id_filter["$in"] = list(medication_index.lookup(medication))
+        metrics.inc("search_documents_examined_total", len(id_filter["$in"]), endpoint="list_pharmacies")
+    if cursor:
+        id_filter["$gt"] = decode_cursor(cursor, "after")["after"]
+    if id_filter:
+        query["id"] = id_filter
+    
+    projection = PHARMACY_SUMMARY_PROJECTION if summary else PHARMACY_PROJECTION
+    pharmacies = await db.pharmacies.find(query, projection).sort("id", 1).limit(limit + 1).to_list(length=limit + 1)
+    
+    headers = {}
+    if len(pharmacies) > limit:
+        pharmacies = pharmacies[:limit]
+        headers["X-Next-Cursor"] = encode_cursor({"after": pharmacies[-1]["id"]})
     
-    # Filter by medication availability if specified
     if medication:
-        filtered_pharmacies = []
+        metrics.inc("search_documents_returned_total", len(pharmacies), endpoint="list_pharmacies")
+    
+    # Stored documents were validated on write; serialize the projected fields as they are
+    if summary:
         for pharmacy in pharmacies:
-            for stock_item in pharmacy.get("stock", []):
-                if (medication.lower() in stock_item.get("medication_name", "").lower() 
-                    and stock_item.get("available", False)):
-                    filtered_pharmacies.append(pharmacy)
-                    break
-        pharmacies = filtered_pharmacies
+            pharmacy["has_stock"] = medication_index.has_available_stock(pharmacy["id"])
+    return LeanJSONResponse(pharmacies, headers=headers)
+
+async def find_nearby_pharmacies(
+    lat: float,
+    lng: float,
+    query: Dict[str, Any],
+    limit: int,
+    radius_km: Optional[float] = None,
+    matched_names: Optional[set] = None,
+    endpoint: str = "nearby"
+) -> List[NearbyPharmacy]:
+    """Nearest pharmacies matching a query, sorted by distance by \$geoNear
+
+    When matched_names is given, each result carries its available stock items
+    with those normalized names.
+    """
+    geo_near = {
+        "near": {"type": "Point", "coordinates": [lng, lat]},
+        "key": "location.geo",
+        "distanceField": "distance_m",
+        "spherical": True,
+        "query": query
+    }
+    if radius_km:
+        geo_near["maxDistance"] = radius_km * 1000
     
-    return [Pharmacy(**pharmacy) for pharmacy in pharmacies]
+    projection = {"_id": 0, "id": 1, "name": 1, "phone": 1, "location": 1, "is_guard": 1, "distance_m": 1}
+    if matched_names:
+        projection["stock"] = 1
+    
+    pharmacies = await db.pharmacies.aggregate([
+        {"$geoNear": geo_near},
+        {"$limit": limit},
+        {"$project": projection}
+    ]).to_list(length=limit)
+    
+    metrics.inc("search_documents_examined_total", len(query.get("id", {}).get("$in", [])), endpoint=endpoint)
+    metrics.inc("search_documents_returned_total", len(pharmacies), endpoint=endpoint)
+    
+    results = []
+    for pharmacy in pharmacies:
+        stock = [
+            stock_item for stock_item in pharmacy.pop("stock", [])
+            if normalize_medication_name(stock_item.get("medication_name", "")) in matched_names
+            and stock_item.get("available", False)
+        ]
+        results.append(NearbyPharmacy(
+            distance_km=round(pharmacy.pop("distance_m") / 1000, 3),
+            stock=stock,
+            **pharmacy
+        ))
+    return results
+
+@app.get("/api/pharmacies/nearby", response_model=List[NearbyPharmacy])
+async def get_nearby_pharmacies(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: Optional[float] = Query(None, gt=0),
+    limit: int = Query(20, ge=1, le=100),
+    medication: Optional[str] = None,
+    is_guard: Optional[bool] = None
+):
+    """Get the nearest pharmacies, sorted by distance, optionally carrying a medication"""
+    query = {}
+    matched_names = set()
+    
+    if is_guard is not None:
+        query["is_guard"] = is_guard
+    if medication:
+        matched_names = set(medication_index.search_names(medication))
+        query["id"] = {"$in": list(medication_index.pharmacy_ids(matched_names))}
+    
+    return await find_nearby_pharmacies(lat, lng, query, limit, radius_km, matched_names)
 
 @app.get("/api/pharmacies/{pharmacy_id}", response_model=Pharmacy)
 async def get_pharmacy(pharmacy_id: str):
     """Get specific pharmacy details"""
-    pharmacy = await db.pharmacies.find_one({"id": pharmacy_id})
+    pharmacy = await load_pharmacy(pharmacy_id)
     if not pharmacy:
         raise HTTPException(status_code=404, detail="Pharmacy not found")
-    return Pharmacy(**pharmacy)
+    return LeanJSONResponse(pharmacy.dict())
+
+def refresh_local_pharmacy_state(pharmacy_id: str, stock: List[Dict[str, Any]]):
+    """Update this worker's index and caches after a pharmacy document changed
+
+    Availability changes are pushed to subscribers. The diff is taken against the
+    index, so a change seen both locally and on the change stream is sent once.
+    """
+    previously_available = medication_index.available_names(pharmacy_id)
+    medication_index.replace_pharmacy(pharmacy_id, stock)
+    # Chat answers are keyed on the stock version, so stale ones are never hit
+    # again and age out of the LRU instead of being searched for here
+    pharmacy_cache.pop(pharmacy_id)
+    prompt_cache.pop(pharmacy_id)
+    
+    now_available = medication_index.available_names(pharmacy_id)
+    back_in_stock = sorted(now_available - previously_available)
+    out_of_stock = sorted(previously_available - now_available)
+    if back_in_stock or out_of_stock:
+        event_bus.publish_pharmacy(pharmacy_id, "stock", {
+            "pharmacy_id": pharmacy_id, "available": back_in_stock, "unavailable": out_of_stock
+        })
+        for name in back_in_stock:
+            event_bus.publish_medication(name, "availability", {"pharmacy_id": pharmacy_id, "medication": name, "available": True})
+        for name in out_of_stock:
+            event_bus.publish_medication(name, "availability", {"pharmacy_id": pharmacy_id, "medication": name, "available": False})
+
+# Per-region availability: medication_offers holds one row per pharmacy and medication
+# it has offered (kept with available False once it runs out), medication_availability
+# the (wilaya, commune, medication) aggregates of the available ones
+STOCK_CHANGE_PROJECTION = {"_id": 0, "id": 1, "stock": 1, "stock_revision": 1, "location.wilaya": 1, "location.commune": 1}
+AVAILABILITY_GROUP = {
+    "pharmacies": {"$sum": 1},
+    "total_quantity": {"$sum": "$quantity"},
+    "min_price": {"$min": "$price"},
+    "max_price": {"$max": "$price"},
+    "avg_price": {"$avg": "$price"}
+}
+
+def medication_offers(stock: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Lowest price and total quantity per normalized available medication"""
+    offers = {}
+    for item in stock:
+        name = normalize_medication_name(item.get("medication_name", ""))
+        if not name or not item.get("available", False):
+            continue
+        offer = offers.get(name)
+        if offer is None:
+            offers[name] = {"price": float(item.get("price", 0)), "quantity": int(item.get("quantity", 0)), "available": True}
+        else:
+            offer["price"] = min(offer["price"], float(item.get("price", 0)))
+            offer["quantity"] += int(item.get("quantity", 0))
+    return offers
+
+async def refresh_availability_aggregates(changed: Dict[tuple, set]):
+    """Recompute the aggregates of the changed medications of each (wilaya, commune)"""
+    if not changed:
+        return
+    regions = [
+        {"wilaya": wilaya, "commune": commune, "medication": {"$in": list(medications)}}
+        for (wilaya, commune), medications in changed.items()
+    ]
+    stats = await db.medication_offers.aggregate([
+        {"$match": {"$or": regions, "available": {"$ne": False}}},
+        {"$group": {"_id": {"wilaya": "$wilaya", "commune": "$commune", "medication": "$medication"}, **AVAILABILITY_GROUP}}
+    ]).to_list(length=None)
+    
+    operations = []
+    remaining = set()
+    updated_at = datetime.now()
+    for entry in stats:
+        key = entry.pop("_id")
+        remaining.add((key["wilaya"], key["commune"], key["medication"]))
+        operations.append(ReplaceOne(key, {**key, **entry, "updated_at": updated_at}, upsert=True))
+    for (wilaya, commune), medications in changed.items():
+        for medication in medications:
+            if (wilaya, commune, medication) not in remaining:
+                operations.append(DeleteOne({"medication": medication, "wilaya": wilaya, "commune": commune}))
+    if operations:
+        await db.medication_availability.bulk_write(operations, ordered=False)
+
+async def update_medication_availability(pharmacies: List[Dict[str, Any]], attempts: int = 3):
+    """Apply new stock snapshots to the offers and the affected regional aggregates
+
+    Takes documents read with STOCK_CHANGE_PROJECTION; the round-trips do not
+    depend on the batch size. Concurrent updates of one pharmacy, from this
+    worker or another, are ordered by stock_revision:
+    - a snapshot older than the pharmacy's watermark (the newest revision
+      applied) is skipped whole;
+    - an offer row is only overwritten by a newer revision, and rows that run
+      out are kept as unavailable, so an older snapshot cannot bring them back;
+    - once written, a snapshot that turns out to be outdated (a newer one ran
+      meanwhile and may have missed its rows) is redone with the current stock.
+    """
+    if not pharmacies:
+        return
+    ids = [pharmacy["id"] for pharmacy in pharmacies]
+    watermarks = {
+        mark["pharmacy_id"]: mark["revision"]
+        async for mark in db.medication_offer_revisions.find({"pharmacy_id": {"$in": ids}}, {"_id": 0})
+    }
+    pharmacies = [
+        pharmacy for pharmacy in pharmacies
+        if pharmacy.get("stock_revision", 0) >= watermarks.get(pharmacy["id"], 0)
+    ]
+    if not pharmacies:
+        return
+    current = defaultdict(dict)
+    async for offer in db.medication_offers.find({"pharmacy_id": {"$in": [pharmacy["id"] for pharmacy in pharmacies]}}, {"_id": 0}):
+        current[offer["pharmacy_id"]][offer["medication"]] = offer
+    
+    operations = []
+    changed = defaultdict(set)
+    for pharmacy in pharmacies:
+        revision = pharmacy.get("stock_revision", 0)
+        region = {"wilaya": pharmacy["location"]["wilaya"], "commune": pharmacy["location"]["commune"]}
+        offers = medication_offers(pharmacy.get("stock", []))
+        previous_offers = current[pharmacy["id"]]
+        for medication in offers.keys() | previous_offers.keys():
+            previous = previous_offers.get(medication)
+            if previous and previous.get("revision", 0) >= revision:
+                continue
+            offer = offers.get(medication) or {"price": previous["price"], "quantity": 0, "available": False}
+            key = {"pharmacy_id": pharmacy["id"], "medication": medication}
+            newer = {**key, "revision": {"$not": {"$gte": revision}}}
+            # Unchanged offers still take the new revision, so older snapshots stay locked out
+            if previous and all(previous.get(field, True) == value for field, value in offer.items()):
+                operations.append(UpdateOne(newer, {"$set": {"revision": revision}}))
+                continue
+            operations.append(ReplaceOne(newer, {**key, **region, **offer, "revision": revision}, upsert=True))
+            changed[(region["wilaya"], region["commune"])].add(medication)
+    
+    if operations:
+        try:
+            await db.medication_offers.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # A duplicate key means a newer revision of that offer is already stored
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    
+    applied = {pharmacy["id"]: pharmacy.get("stock_revision", 0) for pharmacy in pharmacies}
+    try:
+        await db.medication_offer_revisions.bulk_write([
+            UpdateOne({"pharmacy_id": pharmacy_id, "revision": {"$lt": revision}}, {"$set": {"revision": revision}}, upsert=True)
+            for pharmacy_id, revision in applied.items()
+        ], ordered=False)
+    except BulkWriteError as e:
+        # The watermark is already at or past this revision
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+    await refresh_availability_aggregates(changed)
+    
+    outdated = [
+        pharmacy["id"]
+        async for pharmacy in db.pharmacies.find({"id": {"$in": list(applied)}}, {"_id": 0, "id": 1, "stock_revision": 1})
+        if pharmacy.get("stock_revision", 0) > applied[pharmacy["id"]]
+    ]
+    if outdated and attempts > 1:
+        latest = await db.pharmacies.find({"id": {"$in": outdated}}, STOCK_CHANGE_PROJECTION).to_list(length=None)
+        await update_medication_availability(latest, attempts - 1)
+
+async def acquire_maintenance_lock(name: str) -> bool:
+    """Take a lease on a one-off job so concurrent workers do not run it twice
+
+    An expired lease, left by a worker that died mid-job, can be taken over.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        await db.maintenance_locks.update_one(
+            {"_id": name, "expires_at": {"$lt": now}},
+            {"$set": {"expires_at": now + timedelta(seconds=MAINTENANCE_LOCK_TTL_SECONDS)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Held by another worker: the upsert collided with its unexpired lease
+        return False
+    return True
+
+async def release_maintenance_lock(name: str):
+    await db.maintenance_locks.delete_one({"_id": name})
+
+async def rebuild_medication_availability():
+    """Rebuild all offers and aggregates from the pharmacies collection"""
+    await db.medication_offers.delete_many({})
+    await db.medication_offer_revisions.delete_many({})
+    batch = []
+    async for pharmacy in db.pharmacies.find({}, STOCK_CHANGE_PROJECTION):
+        region = {"wilaya": pharmacy["location"]["wilaya"], "commune": pharmacy["location"]["commune"]}
+        revision = pharmacy.get("stock_revision", 0)
+        for medication, offer in medication_offers(pharmacy.get("stock", [])).items():
+            batch.append({"pharmacy_id": pharmacy["id"], "medication": medication, **region, **offer, "revision": revision})
+        if len(batch) >= STOCK_IMPORT_CHUNK_SIZE:
+            await db.medication_offers.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.medication_offers.insert_many(batch, ordered=False)
+    
+    await db.medication_availability.delete_many({})
+    await db.medication_offers.aggregate([
+        {"$group": {"_id": {"wilaya": "$wilaya", "commune": "$commune", "medication": "$medication"}, **AVAILABILITY_GROUP}},
+        {"$replaceWith": {"$mergeObjects": ["$_id", {
+            "pharmacies": "$pharmacies", "total_quantity": "$total_quantity",
+            "min_price": "$min_price", "max_price": "$max_price", "avg_price": "$avg_price",
+            "updated_at": "$$NOW"
+        }]}},
+        {"$merge": {"into": "medication_availability", "on": ["medication", "wilaya", "commune"]}}
+    ]).to_list(length=None)
+
+async def on_stock_changed(pharmacies: List[Dict[str, Any]]):
+    """Run the side effects of stock writes made by this worker
+
+    Takes the written documents read back with STOCK_CHANGE_PROJECTION.
+    """
+    for pharmacy in pharmacies:
+        refresh_local_pharmacy_state(pharmacy["id"], pharmacy.get("stock", []))
+    await update_medication_availability(pharmacies)
+
+def unknown_medications(deltas: List[StockDelta], stock: List[Dict[str, Any]]) -> List[str]:
+    """Delta names that match no stock item after the update, so were not applied"""
+    names = {item["medication_name"] for item in stock}
+    return sorted({delta.medication_name for delta in deltas} - names)
+
+def stock_delta_pipeline(deltas: List[StockDelta]) -> List[Dict[str, Any]]:
+    """Update pipeline applying deltas to the stock array in one atomic write
+
+    Unknown medications are appended first with quantity 0 when the delta gives a
+    price, and left out otherwise (e.g. a sale with a mistyped name). Each matching
+    item then gets its new quantity (never below 0), optional price, and
+    `available` recomputed from the quantity. stock_revision is bumped.
+    
+    Names are client input, so they go in as $literal: a name starting with "$"
+    must not be read as a field path.
+    """
+    pipeline = [{"$set": {"stock": {"$ifNull": ["$stock", []]}}}]
+    for delta in deltas:
+        name = {"$literal": delta.medication_name}
+        if delta.price is not None:
+            new_item = {
+                "medication_name": delta.medication_name,
+                "quantity": 0,
+                "price": delta.price,
+                "available": False
+            }
+            pipeline.append({"$set": {"stock": {"$cond": [
+                {"$in": [name, "$stock.medication_name"]},
+                "$stock",
+                {"$concatArrays": ["$stock", {"$literal": [new_item]}]}
+            ]}}})
+        
+        if delta.quantity is not None:
+            new_quantity = delta.quantity
+        else:
+            new_quantity = {"$max": [0, {"$add": ["$$item.quantity", delta.quantity_delta]}]}
+        # Items are PharmacyStock documents, so the updated item is spelled out field by field
+        updated_item = {
+            "medication_name": "$$item.medication_name",
+            "quantity": "$$quantity",
+            "price": delta.price if delta.price is not None else "$$item.price",
+            "available": {"$gt": ["$$quantity", 0]}
+        }
+        pipeline.append({"$set": {"stock": {"$map": {
+            "input": "$stock",
+            "as": "item",
+            "in": {"$cond": [
+                {"$eq": ["$$item.medication_name", name]},
+                {"$let": {
+                    "vars": {"quantity": new_quantity},
+                    "in": updated_item
+                }},
+                "$$item"
+            ]}
+        }}}})
+    pipeline.append({"$set": {"stock_revision": {"$add": [{"$ifNull": ["$stock_revision", 0]}, 1]}}})
+    return pipeline
 
 @app.post("/api/pharmacies/{pharmacy_id}/stock")
 async def update_pharmacy_stock(pharmacy_id: str, stock: List[PharmacyStock]):
     """Update pharmacy stock"""
-    result = await db.pharmacies.update_one(
+    stock_items = [item.dict() for item in stock]
+    pharmacy = await db.pharmacies.find_one_and_update(
         {"id": pharmacy_id},
-        {"$set": {"stock": [item.dict() for item in stock]}}
+        {"$set": {"stock": stock_items}, "$inc": {"stock_revision": 1}},
+        projection=STOCK_CHANGE_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
-    if result.matched_count == 0:
+    if not pharmacy:
         raise HTTPException(status_code=404, detail="Pharmacy not found")
+    await on_stock_changed([pharmacy])
     return {"message": "Stock updated successfully"}
 
+@app.patch("/api/pharmacies/{pharmacy_id}/stock")
+async def patch_pharmacy_stock(pharmacy_id: str, deltas: List[StockDelta]):
+    """Apply stock deltas (sales, restocks, price changes) without resending the catalog"""
+    pharmacy = await db.pharmacies.find_one_and_update(
+        {"id": pharmacy_id},
+        stock_delta_pipeline(deltas),
+        projection=STOCK_CHANGE_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if not pharmacy:
+        raise HTTPException(status_code=404, detail="Pharmacy not found")
+    await on_stock_changed([pharmacy])
+    return {
+        "message": "Stock updated successfully",
+        "stock": [PharmacyStock(**item) for item in pharmacy["stock"]],
+        "unknown_medications": unknown_medications(deltas, pharmacy["stock"])
+    }
+
+@app.patch("/api/stock")
+async def patch_stock_batch(batch: List[PharmacyStockDeltas]):
+    """Apply stock deltas for many pharmacies in one unordered bulk write"""
+    if not batch:
+        return {"matched": 0, "modified": 0, "missing": [], "unknown_medications": {}}
+    
+    result = await db.pharmacies.bulk_write(
+        [UpdateOne({"id": entry.pharmacy_id}, stock_delta_pipeline(entry.deltas)) for entry in batch],
+        ordered=False
+    )
+    
+    deltas_by_pharmacy = defaultdict(list)
+    for entry in batch:
+        deltas_by_pharmacy[entry.pharmacy_id].extend(entry.deltas)
+    pharmacies = await db.pharmacies.find(
+        {"id": {"$in": list(deltas_by_pharmacy)}}, STOCK_CHANGE_PROJECTION
+    ).to_list(length=None)
+    found = {pharmacy["id"] for pharmacy in pharmacies}
+    unknown = {}
+    for pharmacy in pharmacies:
+        names = unknown_medications(deltas_by_pharmacy[pharmacy["id"]], pharmacy.get("stock", []))
+        if names:
+            unknown[pharmacy["id"]] = names
+    await on_stock_changed(pharmacies)
+    
+    return {
+        "matched": result.matched_count,
+        "modified": result.modified_count,
+        "missing": sorted(set(deltas_by_pharmacy) - found),
+        "unknown_medications": unknown
+    }
+
+def iter_import_rows(upload: UploadFile, file_format: str):
+    """Yield (line number, raw row) from a CSV or NDJSON upload without loading it whole
+
+    Text that is not UTF-8 ends the file with a UnicodeDecodeError row.
+    """
+    text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+    line_number = 0
+    try:
+        if file_format == "csv":
+            reader = csv.DictReader(text)
+            for row in reader:
+                line_number = reader.line_num
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    row = e
+                yield line_number, row
+    except UnicodeDecodeError as e:
+        yield line_number + 1, e
+
+def parse_import_row(row: Any) -> tuple:
+    """Validate one feed row into (pharmacy_id, stock item dict) or raise ValueError"""
+    if isinstance(row, UnicodeDecodeError):
+        raise ValueError(f"file is not UTF-8 text ({row.reason}); the rest of the file was not imported")
+    if isinstance(row, Exception):
+        raise ValueError(f"invalid JSON: {row}")
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+    pharmacy_id = "" if row.get("pharmacy_id") is None else str(row["pharmacy_id"]).strip()
+    if not pharmacy_id:
+        raise ValueError("pharmacy_id is required")
+    fields = {key: value for key, value in row.items() if key in PharmacyStock.__fields__ and value not in (None, "")}
+    if "available" in fields and isinstance(fields["available"], str):
+        fields["available"] = fields["available"].strip().lower() in ("1", "true", "yes", "oui")
+    try:
+        item = PharmacyStock(**fields)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+    if "available" not in fields:
+        item.available = item.quantity > 0
+    return pharmacy_id, item.dict()
+
+def read_import_chunk(rows, report: Dict[str, Any]) -> List[tuple]:
+    """Parse rows until STOCK_IMPORT_CHUNK_SIZE are valid; blocking, so run in a thread"""
+    chunk = []
+    for line_number, row in rows:
+        report["rows"] += 1
+        try:
+            pharmacy_id, item = parse_import_row(row)
+        except ValueError as e:
+            record_import_error(report, line_number, str(e))
+            continue
+        chunk.append((line_number, pharmacy_id, item))
+        if len(chunk) >= STOCK_IMPORT_CHUNK_SIZE:
+            break
+    return chunk
+
+def record_import_error(report: Dict[str, Any], line_number: int, message: str):
+    report["failed"] += 1
+    if len(report["errors"]) < STOCK_IMPORT_MAX_ERRORS:
+        report["errors"].append({"line": line_number, "error": message})
+
+async def write_import_chunk(rows: List[tuple], report: Dict[str, Any]):
+    """Upsert a chunk of (line, pharmacy_id, item) rows into the stock arrays"""
+    pharmacy_ids = {pharmacy_id for _, pharmacy_id, _ in rows}
+    existing = {
+        pharmacy["id"]
+        async for pharmacy in db.pharmacies.find({"id": {"$in": list(pharmacy_ids)}}, {"_id": 0, "id": 1})
+    }
+    
+    operations = []
+    for line_number, pharmacy_id, item in rows:
+        if pharmacy_id not in existing:
+            record_import_error(report, line_number, f"pharmacy {pharmacy_id} not found")
+            continue
+        name = item["medication_name"]
+        # Either the item exists and is updated in place, or it is missing and pushed;
+        # the pair is idempotent, so it is safe in an unordered batch
+        operations.append(UpdateOne(
+            {"id": pharmacy_id, "stock.medication_name": name},
+            {"$set": {f"stock.$.{key}": value for key, value in item.items()}, "$inc": {"stock_revision": 1}}
+        ))
+        operations.append(UpdateOne(
+            {"id": pharmacy_id, "stock.medication_name": {"$ne": name}},
+            {"$push": {"stock": item}, "$inc": {"stock_revision": 1}}
+        ))
+        report["imported"] += 1
+    
+    if operations:
+        await db.pharmacies.bulk_write(operations, ordered=False)
+    
+    touched = existing & pharmacy_ids
+    report["pharmacies"] |= touched
+    pharmacies = await db.pharmacies.find({"id": {"$in": list(touched)}}, STOCK_CHANGE_PROJECTION).to_list(length=None)
+    await on_stock_changed(pharmacies)
+
+@app.post("/api/stock/import")
+async def import_stock(file: UploadFile = File(...), file_format: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$")):
+    """Bulk-load stock from a CSV or NDJSON catalog feed
+
+    Each row needs pharmacy_id, medication_name, quantity and price (available is
+    derived from quantity when missing). Rows are validated and written in chunks,
+    so memory use does not depend on the file size.
+    """
+    if not file_format:
+        file_format = "ndjson" if (file.filename or "").lower().endswith((".ndjson", ".jsonl")) else "csv"
+    
+    report = {"rows": 0, "imported": 0, "failed": 0, "errors": [], "pharmacies": set()}
+    rows = iter_import_rows(file, file_format)
+    # Reading and parsing block, so each chunk is prepared off the event loop
+    while True:
+        chunk = await asyncio.to_thread(read_import_chunk, rows, report)
+        if chunk:
+            await write_import_chunk(chunk, report)
+        if len(chunk) < STOCK_IMPORT_CHUNK_SIZE:
+            break
+    
+    report["pharmacies"] = len(report["pharmacies"])
+    return report
+
+@app.get("/api/medications/availability")
+async def get_medication_availability(medication: str, wilaya: Optional[str] = None, commune: Optional[str] = None):
+    """Per-commune availability summary of a medication: pharmacy count, quantity and prices"""
+    names = medication_index.match_names(medication)
+    query = {"medication": {"$in": list(names)}}
+    if wilaya:
+        query["wilaya"] = wilaya
+    if commune:
+        query["commune"] = commune
+    
+    regions = await db.medication_availability.find(query, {"_id": 0}).sort("min_price", ASCENDING).to_list(length=1000)
+    for region in regions:
+        region["avg_price"] = round(region["avg_price"], 2)
+    return {"medication": medication, "regions": regions, "total_found": len(regions)}
+
+def matching_stock(names) -> Dict[str, Any]:
+    """$project expression keeping the available stock items spelled like the given names"""
+    return {"$filter": {
+        "input": "$stock",
+        "as": "item",
+        "cond": {"$and": [
+            {"$eq": ["$$item.available", True]},
+            {"$in": ["$$item.medication_name", {"$literal": medication_index.spellings(names)}]}
+        ]}
+    }}
+
 @app.post("/api/search-medication")
 async def search_medication(query: UserQuery):
-    """Search for medication availability across pharmacies"""
+    """Search for medication availability across pharmacies, best matches first
+
+    Matching tolerates typos, brand names and dosage spelling; with lat/lng, results
+    of equal relevance are ordered by distance. Every matching pharmacy is ranked
+    before the SEARCH_MAX_PHARMACIES best are loaded; `truncated` tells when some
+    were left out.
+    """
     search_query = {"subscription_active": True}
     
     if query.wilaya:
@@ -219,95 +2169,842 @@ async def search_medication(query: UserQuery):
     if query.quartier:
         search_query["location.quartier"] = query.quartier
     
-    pharmacies = await db.pharmacies.find(search_query).to_list(length=None)
+    scores = medication_index.search_names(query.medication_name)
+    best_scores = medication_index.best_scores(scores)
+    search_query["id"] = {"$in": list(best_scores)}
+    
+    # Rank every match on ids (and coordinates) only, then load the best ones
+    with_distance = query.lat is not None and query.lng is not None
+    projection = {"_id": 0, "id": 1}
+    if with_distance:
+        projection.update({"location.lat": 1, "location.lng": 1})
+    ranked = []
+    async for match in db.pharmacies.find(search_query, projection):
+        distance = 0.0
+        if with_distance:
+            distance = haversine_km(query.lat, query.lng, match["location"]["lat"], match["location"]["lng"])
+        ranked.append((-best_scores[match["id"]], distance, match["id"]))
+    ranked.sort()
+    total_matching = len(ranked)
+    search_query["id"] = {"$in": [pharmacy_id for _, _, pharmacy_id in ranked[:SEARCH_MAX_PHARMACIES]]}
+    
+    # Only the matching, available stock items leave the database; documents were
+    # validated on write, so they are serialized as stored
+    pharmacies = await db.pharmacies.aggregate([
+        {"$match": search_query},
+        {"$project": {**SEARCH_PHARMACY_PROJECTION, "stock": matching_stock(scores)}}
+    ]).to_list(length=SEARCH_MAX_PHARMACIES)
     
+    # One entry per pharmacy: its summary once, then every matching stock item
     results = []
+    total_found = 0
     for pharmacy in pharmacies:
-        for stock_item in pharmacy.get("stock", []):
-            if (query.medication_name.lower() in stock_item.get("medication_name", "").lower()
-                and stock_item.get("available", False)):
-                results.append({
-                    "pharmacy": Pharmacy(**pharmacy),
-                    "stock_item": PharmacyStock(**stock_item)
-                })
+        matches = []
+        for stock_item in pharmacy.pop("stock", None) or []:
+            score = scores.get(normalize_medication_name(stock_item["medication_name"]))
+            if score:
+                matches.append({"stock_item": stock_item, "score": score})
+        if not matches:
+            continue
+        matches.sort(key=lambda match: -match["score"])
+        distance_km = None
+        if with_distance:
+            location = pharmacy["location"]
+            distance_km = round(haversine_km(query.lat, query.lng, location["lat"], location["lng"]), 3)
+        results.append({
+            "pharmacy": pharmacy,
+            "matches": matches,
+            "score": matches[0]["score"],
+            "distance_km": distance_km
+        })
+        total_found += len(matches)
+    results.sort(key=lambda result: (-result["score"], result["distance_km"] or 0.0))
+    
+    metrics.inc("search_documents_examined_total", len(best_scores), endpoint="search_medication")
+    metrics.inc("search_documents_returned_total", total_found, endpoint="search_medication")
+    return LeanJSONResponse({
+        "results": results,
+        "total_found": total_found,
+        "total_pharmacies": len(results),
+        "total_matching_pharmacies": total_matching,
+        "truncated": total_matching > SEARCH_MAX_PHARMACIES
+    })
+
+# Basket fulfillment. Items only match their best-scoring names with every dosage
+# they give, so a basket line is not silently filled with another dosage.
+BASKET_SCORE_MARGIN = 0.1
+
+def basket_item_names(medication: str) -> set:
+    scores = medication_index.search_names(medication)
+    dosages = medication_dosages(medication)
+    if dosages:
+        scores = {name: score for name, score in scores.items() if dosages <= set(medication_tokens(name))}
+    if not scores:
+        return set()
+    best = max(scores.values())
+    return {name for name, score in scores.items() if score >= best - BASKET_SCORE_MARGIN}
+
+def basket_candidates(coverage: Dict[str, set], distances: Dict[str, float], limit: int) -> List[str]:
+    """Up to limit pharmacy ids to consider for a basket
+
+    coverage maps pharmacy id -> indexes of the basket items it has. A greedy
+    cover of every item some pharmacy has comes first, so a rare item is not cut
+    off by the cap; the remaining slots go to the pharmacies covering the most
+    items, nearest first.
+    """
+    def rank(pharmacy_id: str, items: set) -> tuple:
+        return (-len(items & coverage[pharmacy_id]), distances.get(pharmacy_id, 0.0), pharmacy_id)
+    
+    chosen = []
+    uncovered = set().union(*coverage.values())
+    while uncovered and len(chosen) < limit:
+        pharmacy_id = min((pharmacy_id for pharmacy_id in coverage if pharmacy_id not in chosen),
+                          key=lambda pharmacy_id: rank(pharmacy_id, uncovered))
+        chosen.append(pharmacy_id)
+        uncovered -= coverage[pharmacy_id]
+    everything = set().union(*coverage.values())
+    rest = sorted((pharmacy_id for pharmacy_id in coverage if pharmacy_id not in chosen),
+                  key=lambda pharmacy_id: rank(pharmacy_id, everything))
+    return chosen + rest[:limit - len(chosen)]
+
+def cover_basket(offers: Dict[str, Dict[int, Dict[str, Any]]], items: List[int], objective: str,
+                 distances: Dict[str, float]) -> Dict[int, str]:
+    """Assign basket items to pharmacies; returns item index -> pharmacy id
+
+    offers maps pharmacy id -> item index -> cheapest matching stock item.
+    "cheapest" takes every item where it costs least (optimal for the total);
+    "fewest_stops" runs the greedy set-cover heuristic (most uncovered items,
+    then lowest cost, then nearest), then buys each item at the cheapest
+    chosen pharmacy and drops pharmacies left with nothing to buy.
+    """
+    def price(pharmacy_id: str, item: int) -> float:
+        return offers[pharmacy_id][item]["price"]
+    
+    if objective == "cheapest":
+        chosen = set(offers)
+    else:
+        chosen = set()
+        uncovered = {item for item in items if any(item in stock for stock in offers.values())}
+        while uncovered:
+            pharmacy_id = min(
+                (pharmacy_id for pharmacy_id in offers if pharmacy_id not in chosen),
+                key=lambda pharmacy_id: (
+                    -len(uncovered & offers[pharmacy_id].keys()),
+                    sum(price(pharmacy_id, item) for item in uncovered & offers[pharmacy_id].keys()),
+                    distances.get(pharmacy_id, 0.0)
+                )
+            )
+            chosen.add(pharmacy_id)
+            uncovered -= offers[pharmacy_id].keys()
+    
+    assignment = {}
+    for item in items:
+        sellers = [pharmacy_id for pharmacy_id in chosen if item in offers[pharmacy_id]]
+        if sellers:
+            assignment[item] = min(sellers, key=lambda pharmacy_id: (price(pharmacy_id, item), distances.get(pharmacy_id, 0.0)))
+    return assignment
+
+@app.post("/api/basket")
+async def fulfill_basket(basket: BasketQuery):
+    """Pharmacies that together supply a list of medications, by fewest stops or cheapest total
+
+    Every matching pharmacy is ranked by the items it covers (and distance) from
+    the medication index before the best `candidates` are loaded, with their
+    matching stock, in one query; items no candidate has are listed under missing.
+    """
+    if (basket.lat is None) != (basket.lng is None):
+        raise HTTPException(status_code=400, detail="lat and lng must be given together")
+    
+    item_names = [basket_item_names(medication) for medication in basket.medications]
+    all_names = set().union(*item_names)
+    coverage = defaultdict(set)
+    for item, names in enumerate(item_names):
+        for pharmacy_id in medication_index.pharmacy_ids(names):
+            coverage[pharmacy_id].add(item)
+    query = {"subscription_active": True, "id": {"$in": list(coverage)}}
+    if basket.wilaya:
+        query["location.wilaya"] = basket.wilaya
+    if basket.commune:
+        query["location.commune"] = basket.commune
+    
+    # Rank on ids (and coordinates) only, then load the chosen candidates
+    with_distance = basket.lat is not None
+    projection = {"_id": 0, "id": 1}
+    if with_distance:
+        projection.update({"location.lat": 1, "location.lng": 1})
+    matching = {}
+    distances = {}
+    async for match in db.pharmacies.find(query, projection):
+        if with_distance:
+            distance = haversine_km(basket.lat, basket.lng, match["location"]["lat"], match["location"]["lng"])
+            if basket.radius_km and distance > basket.radius_km:
+                continue
+            distances[match["id"]] = round(distance, 3)
+        matching[match["id"]] = coverage[match["id"]]
+    chosen = basket_candidates(matching, distances, basket.candidates)
+    
+    candidates = await db.pharmacies.aggregate([
+        {"$match": {"id": {"$in": chosen}}},
+        {"$project": {**PHARMACY_SUMMARY_PROJECTION, "stock": matching_stock(all_names)}}
+    ]).to_list(length=len(chosen))
+    metrics.inc("search_documents_examined_total", len(matching), endpoint="basket")
+    metrics.inc("search_documents_returned_total", len(candidates), endpoint="basket")
+    
+    # Candidate matrix: pharmacy -> basket item -> cheapest matching stock item
+    pharmacies = {}
+    offers = {}
+    for pharmacy in candidates:
+        stock = pharmacy.pop("stock", None) or []
+        if with_distance:
+            pharmacy["distance_km"] = distances[pharmacy["id"]]
+        pharmacy_offers = {}
+        for stock_item in stock:
+            name = normalize_medication_name(stock_item["medication_name"])
+            for item, names in enumerate(item_names):
+                if name in names and (item not in pharmacy_offers or stock_item["price"] < pharmacy_offers[item]["price"]):
+                    pharmacy_offers[item] = stock_item
+        if pharmacy_offers:
+            pharmacies[pharmacy["id"]] = pharmacy
+            offers[pharmacy["id"]] = pharmacy_offers
+    
+    items = list(range(len(basket.medications)))
+    assignment = cover_basket(offers, items, basket.objective, distances)
+    
+    stops = {}
+    for item, pharmacy_id in assignment.items():
+        stop = stops.setdefault(pharmacy_id, {"pharmacy": pharmacies[pharmacy_id], "items": [], "subtotal": 0.0})
+        stop["items"].append({"medication": basket.medications[item], "stock_item": offers[pharmacy_id][item]})
+        stop["subtotal"] = round(stop["subtotal"] + offers[pharmacy_id][item]["price"], 2)
     
-    return {"results": results, "total_found": len(results)}
+    return LeanJSONResponse({
+        "objective": basket.objective,
+        "stops": sorted(stops.values(), key=lambda stop: (-len(stop["items"]), stop["pharmacy"].get("distance_km", 0.0))),
+        "total_price": round(sum(stop["subtotal"] for stop in stops.values()), 2),
+        "covered": len(assignment),
+        "missing": [basket.medications[item] for item in items if item not in assignment]
+    })
+
+CHAT_UNAVAILABLE_MESSAGE = "Désolé, le service de chat IA n'est pas disponible pour le moment. Veuillez contacter directement la pharmacie."
+
+# Words of a chat question that never name a medication
+CHAT_STOPWORDS = {
+    "avez", "avoir", "vous", "est", "que", "qui", "quoi", "quel", "quelle", "quels", "quelles",
+    "les", "des", "une", "pour", "avec", "dans", "sur", "pas", "oui", "non", "mais", "plus",
+    "prix", "combien", "coute", "cout", "disponible", "disponibles", "dispo", "stock", "rupture",
+    "bonjour", "bonsoir", "merci", "svp", "medicament", "medicaments", "pharmacie", "boite", "boites",
+    "livraison", "retrait", "aujourd", "hui", "demain", "encore", "aussi", "autre", "alternative",
+}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) used for prompt budgeting"""
+    return len(text) // 4 + 1
+
+class PharmacyPrompt:
+    """Chat prompt parts of one pharmacy, built once per stock version
+
+    Holds the static instructions, one compact table row per stock item and a
+    private MedicationIndex over every stock name (available or not) used to
+    pick the rows relevant to a question.
+    """
+
+    def __init__(self, pharmacy: Pharmacy):
+        self.source = pharmacy
+        self.version = stock_version(pharmacy)
+        self.header = (
+            f"Tu es l'assistant IA de la pharmacie {pharmacy.name} située à {pharmacy.location.address}.\n"
+            "Réponds en français, de façon professionnelle et utile. Tu peux confirmer la disponibilité "
+            "des médicaments, proposer des alternatives si en rupture, donner les prix et orienter vers "
+            "la livraison ou le retrait en magasin.\n"
+            "Stock (médicament|quantité|prix DA|disponible):"
+        )
+        self.rows: Dict[str, List[str]] = defaultdict(list)
+        for item in pharmacy.stock:
+            name = normalize_medication_name(item.medication_name)
+            self.rows[name].append(f"{item.medication_name}|{item.quantity}|{item.price:g}|{'oui' if item.available else 'non'}")
+        self.row_count = len(pharmacy.stock)
+        # Available names first when filling the remaining budget
+        self.fill_order = sorted(self.rows, key=lambda name: not any(row.endswith("|oui") for row in self.rows[name]))
+        self.index = MedicationIndex()
+        self.index.replace_pharmacy(pharmacy.id, [
+            {"medication_name": item.medication_name, "available": True} for item in pharmacy.stock
+        ])
+        self.static_tokens = estimate_tokens(self.header) + 20
+
+    def matches(self, pharmacy: Pharmacy) -> bool:
+        """Whether this prompt was built from the same name, address and stock"""
+        if pharmacy is self.source:
+            return True
+        if (pharmacy.name, pharmacy.location.address) != (self.source.name, self.source.location.address):
+            return False
+        if stock_version(pharmacy) != self.version:
+            return False
+        self.source = pharmacy
+        return True
+
+prompt_cache = LRUCache(PHARMACY_CACHE_SIZE, PHARMACY_CACHE_TTL)
+
+def pharmacy_prompt(pharmacy: Pharmacy) -> PharmacyPrompt:
+    """Prompt parts for a pharmacy, rebuilt when the cached ones come from other data
+
+    prompt_cache and pharmacy_cache expire independently, so the cached prompt is
+    checked against the Pharmacy actually being answered for.
+    """
+    prompt = prompt_cache.get(pharmacy.id)
+    if prompt is None or not prompt.matches(pharmacy):
+        prompt = PharmacyPrompt(pharmacy)
+        prompt_cache.set(pharmacy.id, prompt)
+    return prompt
+
+async def load_chat_history(pharmacy_id: str, conversation_id: Optional[str]) -> List[Dict[str, Any]]:
+    """Latest exchanges of a conversation from the last CHAT_HISTORY_MINUTES, newest first
+
+    There is no authentication, so user_id cannot be trusted to tell users apart;
+    history is only replayed for an unguessable client-generated conversation id.
+    """
+    if not conversation_id or CHAT_HISTORY_MESSAGES <= 0:
+        return []
+    since = datetime.now() - timedelta(minutes=CHAT_HISTORY_MINUTES)
+    # Chat messages are written behind, so the latest turns may still be buffered;
+    # read the buffer first so a turn flushed in between is found in one of the two
+    buffered = chat_message_writer.pending(lambda document: (
+        document["pharmacy_id"] == pharmacy_id
+        and document.get("conversation_id") == conversation_id
+        and document["created_at"] >= since
+    ))
+    stored = await db.chat_messages.find(
+        {"pharmacy_id": pharmacy_id, "conversation_id": conversation_id, "created_at": {"$gte": since}},
+        {"_id": 0, "id": 1, "message": 1, "response": 1, "created_at": 1}
+    ).sort("created_at", DESCENDING).limit(CHAT_HISTORY_MESSAGES).to_list(length=CHAT_HISTORY_MESSAGES)
+    exchanges = {exchange["id"]: exchange for exchange in stored + buffered}
+    return sorted(exchanges.values(), key=lambda exchange: exchange["created_at"], reverse=True)[:CHAT_HISTORY_MESSAGES]
+
+def build_chat_messages(pharmacy: Pharmacy, message: str, history: List[Dict[str, Any]] = ()) -> List[Dict[str, str]]:
+    """System prompt, recent history and the user's message, within CHAT_PROMPT_TOKENS
+
+    The budget goes first to the stock rows matching the question, then to the
+    history (newest exchanges first), then to the other rows, available first.
+    """
+    prompt = pharmacy_prompt(pharmacy)
+    budget = CHAT_PROMPT_TOKENS - prompt.static_tokens - estimate_tokens(message)
+    
+    rows = []
+    listed = set()
+    
+    def add_rows(name: str) -> bool:
+        nonlocal budget
+        cost = sum(estimate_tokens(row) for row in prompt.rows[name])
+        if cost > budget:
+            return False
+        rows.extend(prompt.rows[name])
+        listed.add(name)
+        budget -= cost
+        return True
+    
+    relevant = prompt.index.rank_names(message, CHAT_STOPWORDS)
+    for name in sorted(relevant, key=lambda name: -relevant[name]):
+        if not add_rows(name):
+            break
+    
+    turns = []
+    for exchange in history:
+        exchange_turns = [{"role": "user", "content": exchange["message"]}]
+        if exchange.get("response"):
+            exchange_turns.append({"role": "assistant", "content": exchange["response"]})
+        cost = sum(estimate_tokens(turn["content"]) for turn in exchange_turns)
+        if cost > budget:
+            break
+        turns = exchange_turns + turns
+        budget -= cost
+    
+    for name in prompt.fill_order:
+        if name not in listed and not add_rows(name):
+            break
+    
+    omitted = prompt.row_count - len(rows)
+    system = "\n".join([prompt.header, *rows] + ([f"(+{omitted} autres références non listées)"] if omitted else []))
+    return [{"role": "system", "content": system}, *turns, {"role": "user", "content": message}]
+
+def record_llm_usage(usage: Any):
+    if usage:
+        metrics.inc("llm_tokens_total", usage.prompt_tokens, kind="prompt", model=OPENAI_MODEL)
+        metrics.inc("llm_tokens_total", usage.completion_tokens, kind="completion", model=OPENAI_MODEL)
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format one Server-Sent Events frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.post("/api/chat/{pharmacy_id}")
-async def chat_with_pharmacy(pharmacy_id: str, message: str, user_id: str):
-    """Chat with pharmacy AI agent"""
+async def chat_with_pharmacy(
+    pharmacy_id: str,
+    message: str,
+    user_id: str,
+    conversation_id: Optional[str] = Query(None, min_length=16, max_length=64)
+):
+    """Chat with pharmacy AI agent
+
+    Pass the same conversation_id (e.g. a UUID generated by the client) on each
+    message of a chat session to give the model the previous exchanges.
+    """
     try:
         # Check if OpenAI client is available
         if not openai_client:
-            return {"response": "Désolé, le service de chat IA n'est pas disponible pour le moment. Veuillez contacter directement la pharmacie."}
+            return {"response": CHAT_UNAVAILABLE_MESSAGE}
         
         # Get pharmacy details
-        pharmacy = await db.pharmacies.find_one({"id": pharmacy_id})
+        pharmacy = await load_pharmacy(pharmacy_id)
         if not pharmacy:
             raise HTTPException(status_code=404, detail="Pharmacy not found")
         
-        # Create context for AI
-        pharmacy_context = f"""
-        Tu es l'assistant IA de la pharmacie {pharmacy['name']} située à {pharmacy['location']['address']}.
+        # Reuse the answer to the same opening question against the same stock;
+        # follow-ups depend on the conversation so they always go to the model
+        history = await load_chat_history(pharmacy_id, conversation_id)
+        cache_key = chat_cache_key(pharmacy, message)
+        ai_response = None if history else chat_cache.get(cache_key)
         
-        Stock disponible:
-        """
-        
-        for item in pharmacy.get("stock", []):
-            status = "Disponible" if item.get("available") else "Rupture de stock"
-            pharmacy_context += f"- {item.get('medication_name')}: {item.get('quantity')} unités, {item.get('price')} DA ({status})\n"
-        
-        pharmacy_context += """
-        
-        Réponds en français. Tu peux:
-        1. Confirmer la disponibilité des médicaments
-        2. Proposer des alternatives si en rupture
-        3. Donner les prix
-        4. Orienter vers la livraison ou retrait en magasin
-        
-        Sois professionnel et utile.
-        """
-        
-        # Call OpenAI API
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": pharmacy_context},
-                {"role": "user", "content": message}
-            ],
-            max_tokens=300,
-            temperature=0.7
-        )
-        
-        ai_response = response.choices[0].message.content
+        if ai_response is None:
+            # Call OpenAI API without blocking the event loop
+            async with llm_semaphore:
+                with metrics.time("llm_request_duration_seconds", mode="complete"):
+                    response = await openai_client.chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=build_chat_messages(pharmacy, message, history),
+                        max_tokens=300,
+                        temperature=0.7
+                    )
+            
+            record_llm_usage(response.usage)
+            ai_response = response.choices[0].message.content
+            if not history:
+                chat_cache.set(cache_key, ai_response)
         
         # Save chat message
         chat_message = ChatMessage(
             pharmacy_id=pharmacy_id,
             user_id=user_id,
             message=message,
-            response=ai_response
+            response=ai_response,
+            conversation_id=conversation_id
         )
         
-        await db.chat_messages.insert_one(chat_message.dict())
+        await chat_message_writer.add(chat_message.dict())
         
         return {"response": ai_response}
         
     except Exception as e:
         return {"response": f"Désolé, une erreur est survenue: {str(e)}. Veuillez contacter directement la pharmacie."}
 
+@app.post("/api/chat/{pharmacy_id}/stream")
+async def stream_chat_with_pharmacy(
+    pharmacy_id: str,
+    message: str,
+    user_id: str,
+    conversation_id: Optional[str] = Query(None, min_length=16, max_length=64)
+):
+    """Chat with pharmacy AI agent, streaming tokens as Server-Sent Events
+
+    Emits `token` events as the completion arrives, then a `done` event with the
+    saved message id, or an `error` event.
+    """
+    pharmacy = await load_pharmacy(pharmacy_id)
+    if not pharmacy:
+        raise HTTPException(status_code=404, detail="Pharmacy not found")
+    
+    async def event_stream():
+        if not openai_client:
+            yield sse_event({"token": CHAT_UNAVAILABLE_MESSAGE}, "token")
+            yield sse_event({"message_id": None}, "done")
+            return
+        
+        try:
+            history = await load_chat_history(pharmacy_id, conversation_id)
+            cache_key = chat_cache_key(pharmacy, message)
+            chunks = []
+            cached_response = None if history else chat_cache.get(cache_key)
+            if cached_response is not None:
+                chunks.append(cached_response)
+                yield sse_event({"token": cached_response}, "token")
+            else:
+                async with llm_semaphore:
+                    started = time.perf_counter()
+                    stream = await openai_client.chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=build_chat_messages(pharmacy, message, history),
+                        max_tokens=300,
+                        temperature=0.7,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+                    async for chunk in stream:
+                        record_llm_usage(getattr(chunk, "usage", None))
+                        if not chunk.choices:
+                            continue
+                        token = chunk.choices[0].delta.content
+                        if token:
+                            if not chunks:
+                                metrics.observe("llm_time_to_first_token_seconds", time.perf_counter() - started)
+                            chunks.append(token)
+                            yield sse_event({"token": token}, "token")
+                    metrics.observe("llm_request_duration_seconds", time.perf_counter() - started, mode="stream")
+                
+                if not history:
+                    chat_cache.set(cache_key, "".join(chunks))
+            
+            # Save the complete answer once the stream has finished
+            chat_message = ChatMessage(
+                pharmacy_id=pharmacy_id,
+                user_id=user_id,
+                message=message,
+                response="".join(chunks),
+                conversation_id=conversation_id
+            )
+            await chat_message_writer.add(chat_message.dict())
+            yield sse_event({"message_id": chat_message.id}, "done")
+        except Exception as e:
+            yield sse_event({"detail": f"Désolé, une erreur est survenue: {str(e)}. Veuillez contacter directement la pharmacie."}, "error")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/diagnostics/query-plans")
+async def get_query_plans():
+    """Explain every query shape; responds 503 if any of them scans a whole collection
+
+    That is a collection scan, or a filtered query walking a full index (an index
+    scan without bounds, then fetching every document to filter it).
+    """
+    report = []
+    for name, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+        report.append({
+            "name": name,
+            "collection": collection,
+            "stages": [stage["stage"] for stage in stages],
+            "collscan": any(stage["stage"] == "COLLSCAN" for stage in stages),
+            "unbounded_scan": bool(query) and any(is_unbounded_scan(stage) for stage in stages)
+        })
+    
+    collscans = [shape["name"] for shape in report if shape["collscan"]]
+    unbounded = [shape["name"] for shape in report if shape["unbounded_scan"]]
+    failed = collscans or unbounded
+    return JSONResponse(
+        status_code=503 if failed else 200,
+        content={"ok": not failed, "collscans": collscans, "unbounded_scans": unbounded, "shapes": report}
+    )
+
+@app.get("/api/events")
+async def subscribe_events(
+    request: Request,
+    pharmacy_id: List[str] = Query([]),
+    user_id: List[str] = Query([]),
+    medication: List[str] = Query([])
+):
+    """Server-Sent Events push channel
+
+    Subscribe to `stock` and `prescription` events of pharmacies, `prescription`
+    events of users, and `availability` events of medications. A medication is a
+    full name or one word of it ("doliprane" follows "Doliprane 1000mg"). Each
+    parameter can be repeated.
+    """
+    if not (pharmacy_id or user_id or medication):
+        raise HTTPException(status_code=400, detail="Subscribe to at least one pharmacy_id, user_id or medication")
+    
+    queue = event_bus.subscribe(pharmacy_id, user_id, medication)
+    
+    async def event_stream():
+        try:
+            yield sse_event({"subscribed": True}, "ready")
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event(data, event)
+        finally:
+            event_bus.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics for this worker"""
+    for name, cache in (("chat", chat_cache), ("pharmacies", pharmacy_cache)):
+        metrics.set("cache_entries", len(cache), cache=name)
+        metrics.set("cache_lookups_total", cache.hits, cache=name, result="hit")
+        metrics.set("cache_lookups_total", cache.misses, cache=name, result="miss")
+    metrics.set("event_subscribers", event_bus.subscribers)
+    metrics.set("events_dropped_total", event_bus.dropped)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Hit/miss counters of the in-process caches"""
+    return {"chat": chat_cache.stats(), "pharmacies": pharmacy_cache.stats(), "guard": guard_cache.stats(), "prompts": prompt_cache.stats()}
+
 @app.post("/api/prescriptions")
-async def submit_prescription(prescription: Prescription):
-    """Submit a prescription to a pharmacy"""
-    await db.prescriptions.insert_one(prescription.dict())
+async def submit_prescription(prescription: Prescription, durable: bool = False):
+    """Submit a prescription to a pharmacy
+
+    The insert is batched with others; durable=true waits until it is written.
+    Listings include it and status updates flush it first, so it can be read and
+    updated right away either way.
+    """
+    await prescription_writer.add(prescription.dict(), wait=durable)
     return {"message": "Prescription submitted successfully", "prescription_id": prescription.id}
 
-@app.get("/api/prescriptions/{user_id}")
-async def get_user_prescriptions(user_id: str):
-    """Get user's prescriptions"""
-    prescriptions = await db.prescriptions.find({"user_id": user_id}).to_list(length=None)
+@app.post("/api/prescriptions/upload")
+async def upload_prescription(request: Request, user_id: str, pharmacy_id: str):
+    """Upload a prescription image as the raw request body
+
+    The image is streamed to disk and the prescription is created as pending;
+    medications are extracted in the background, which moves it to processed.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in PRESCRIPTION_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Unsupported image type, expected one of {', '.join(PRESCRIPTION_CONTENT_TYPES)}")
+    
+    prescription = Prescription(user_id=user_id, pharmacy_id=pharmacy_id, medications=[])
+    image_path = os.path.join(PRESCRIPTION_UPLOAD_DIR, prescription.id + PRESCRIPTION_CONTENT_TYPES[content_type])
+    size = await save_request_body(request, image_path)
+    if size == 0:
+        raise HTTPException(status_code=400, detail="Empty prescription image")
+    
+    prescription.image_url = f"/api/prescriptions/{prescription.id}/image"
+    document = prescription.dict()
+    document["image_path"] = image_path
+    await db.prescriptions.insert_one(document)
+    prescription_queue.put_nowait(prescription.id)
+    
+    return {"message": "Prescription uploaded successfully", "prescription_id": prescription.id, "status": prescription.status}
+
+@app.get("/api/prescriptions/{prescription_id}/image")
+async def get_prescription_image(prescription_id: str):
+    """Stream a prescription's uploaded image"""
+    prescription = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0, "image_path": 1})
+    if not prescription or not prescription.get("image_path") or not os.path.exists(prescription["image_path"]):
+        raise HTTPException(status_code=404, detail="Prescription image not found")
+    return FileResponse(prescription["image_path"])
+
+async def list_prescriptions(
+    response: Response,
+    owner_filter: Dict[str, Any],
+    status: Optional[str],
+    limit: int,
+    cursor: Optional[str]
+) -> List[Prescription]:
+    """Newest-first page of prescriptions; the next cursor goes in X-Next-Cursor"""
+    query = dict(owner_filter)
+    if status:
+        if status not in PRESCRIPTION_STATUSES:
+            raise HTTPException(status_code=400, detail=f"Unknown status {status}")
+        query["status"] = status
+    if cursor:
+        position = decode_cursor(cursor, "created_at", "id")
+        try:
+            created_at = datetime.fromisoformat(position["created_at"])
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": position["id"]}}
+        ]
+    
+    def on_page(document: Dict[str, Any]) -> bool:
+        if any(document.get(field) != value for field, value in owner_filter.items()):
+            return False
+        if status and document["status"] != status:
+            return False
+        return not cursor or (document["created_at"], document["id"]) < (created_at, position["id"])
+    
+    # Submissions are written behind, so merge in the ones still buffered
+    buffered = prescription_writer.pending(on_page)
+    stored = await db.prescriptions.find(query).sort(
+        [("created_at", DESCENDING), ("id", DESCENDING)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+    prescriptions = sorted(
+        {prescription["id"]: prescription for prescription in stored + buffered}.values(),
+        key=lambda prescription: (prescription["created_at"], prescription["id"]),
+        reverse=True
+    )[:limit + 1]
+    
+    if len(prescriptions) > limit:
+        prescriptions = prescriptions[:limit]
+        last = prescriptions[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({"created_at": last["created_at"].isoformat(), "id": last["id"]})
+    
     return [Prescription(**prescription) for prescription in prescriptions]
 
+@app.get("/api/prescriptions/{user_id}", response_model=List[Prescription])
+async def get_user_prescriptions(
+    response: Response,
+    user_id: str,
+    status: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None
+):
+    """Get user's prescriptions, newest first"""
+    return await list_prescriptions(response, {"user_id": user_id}, status, limit, cursor)
+
+@app.get("/api/pharmacies/{pharmacy_id}/prescriptions", response_model=List[Prescription])
+async def get_pharmacy_prescriptions(
+    response: Response,
+    pharmacy_id: str,
+    status: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None
+):
+    """Get prescriptions addressed to a pharmacy, newest first"""
+    return await list_prescriptions(response, {"pharmacy_id": pharmacy_id}, status, limit, cursor)
+
+@app.post("/api/pharmacies/{pharmacy_id}/prescriptions/status")
+async def update_prescriptions_status(pharmacy_id: str, update: PrescriptionStatusUpdate):
+    """Move many of a pharmacy's prescriptions to a later status in one write
+
+    Prescriptions that are unknown, addressed to another pharmacy or already at
+    or past the target status are skipped.
+    """
+    if update.status not in PRESCRIPTION_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Unknown status {update.status}")
+    
+    earlier_statuses = PRESCRIPTION_STATUSES[:PRESCRIPTION_STATUSES.index(update.status)]
+    requested = set(update.prescription_ids)
+    if prescription_writer.pending(lambda document: document["id"] in requested):
+        await prescription_writer.flush()
+    updated_at = datetime.now()
+    result = await db.prescriptions.update_many(
+        {"pharmacy_id": pharmacy_id, "id": {"$in": update.prescription_ids}, "status": {"$in": earlier_statuses}},
+        {"$set": {"status": update.status, "updated_at": updated_at}}
+    )
+    
+    # Only look up who to notify when someone is listening here; with the change
+    # stream on, the notification comes from watch_prescription_changes
+    if result.modified_count and event_bus.subscribers and not PHARMACY_CHANGE_STREAM:
+        async for prescription in db.prescriptions.find(
+            {"pharmacy_id": pharmacy_id, "id": {"$in": update.prescription_ids}, "updated_at": updated_at},
+            {"_id": 0, "id": 1, "user_id": 1, "pharmacy_id": 1}
+        ):
+            publish_prescription_status(prescription, update.status)
+    return {"updated": result.modified_count, "skipped": len(set(update.prescription_ids)) - result.modified_count}
+
+# Guard duty (pharmacie de garde) rotation. Each duty lists the hour buckets it
+# overlaps, so "on duty now" is an index lookup on the current bucket.
+guard_cache = LRUCache(256, GUARD_CACHE_TTL)
+
+def hour_bucket(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H")
+
+def duty_buckets(starts_at: datetime, ends_at: datetime) -> List[str]:
+    buckets = []
+    moment = starts_at.replace(minute=0, second=0, microsecond=0)
+    while moment < ends_at:
+        buckets.append(hour_bucket(moment))
+        moment += timedelta(hours=1)
+    return buckets
+
+async def guard_duties_in_bucket(bucket: str, wilaya: Optional[str], commune: Optional[str]) -> List[Dict[str, Any]]:
+    """Duties of a region overlapping an hour bucket, cached per (region, bucket)"""
+    key = (wilaya, commune, bucket)
+    duties = guard_cache.get(key)
+    if duties is None:
+        query = {"buckets": bucket}
+        if wilaya:
+            query["wilaya"] = wilaya
+        if commune:
+            query["commune"] = commune
+        duties = await db.guard_duties.find(
+            query, {"_id": 0, "pharmacy_id": 1, "starts_at": 1, "ends_at": 1}
+        ).to_list(length=None)
+        guard_cache.set(key, duties)
+    return duties
+
+@app.post("/api/guard-duties")
+async def import_guard_duties(duties: List[GuardDuty]):
+    """Import guard duty shifts; a shift is identified by pharmacy and start time
+
+    Times with an offset are converted to UTC, times without one are taken as UTC.
+    """
+    pharmacy_ids = {duty.pharmacy_id for duty in duties}
+    regions = {
+        pharmacy["id"]: {"wilaya": pharmacy["location"]["wilaya"], "commune": pharmacy["location"]["commune"]}
+        async for pharmacy in db.pharmacies.find(
+            {"id": {"$in": list(pharmacy_ids)}}, {"_id": 0, "id": 1, "location.wilaya": 1, "location.commune": 1}
+        )
+    }
+    
+    operations = []
+    errors = []
+    for position, duty in enumerate(duties):
+        if duty.pharmacy_id not in regions:
+            errors.append({"index": position, "error": f"pharmacy {duty.pharmacy_id} not found"})
+            continue
+        if not duty.starts_at < duty.ends_at <= duty.starts_at + timedelta(hours=GUARD_DUTY_MAX_HOURS):
+            errors.append({"index": position, "error": f"shift must end after it starts and last at most {GUARD_DUTY_MAX_HOURS}h"})
+            continue
+        key = {"pharmacy_id": duty.pharmacy_id, "starts_at": duty.starts_at}
+        operations.append(ReplaceOne(key, {
+            **key,
+            **regions[duty.pharmacy_id],
+            "ends_at": duty.ends_at,
+            "buckets": duty_buckets(duty.starts_at, duty.ends_at)
+        }, upsert=True))
+    
+    if operations:
+        await db.guard_duties.bulk_write(operations, ordered=False)
+        guard_cache.clear()
+    return {"imported": len(operations), "failed": len(errors), "errors": errors}
+
+@app.get("/api/guard-pharmacies/now")
+async def get_guard_pharmacies_now(
+    wilaya: Optional[str] = None,
+    commune: Optional[str] = None,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius_km: Optional[float] = Query(None, gt=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Pharmacies on guard duty right now in a region, or nearest first when lat/lng are given
+
+    as_of and on_duty_until are naive UTC times.
+    """
+    if (lat is None) != (lng is None):
+        raise HTTPException(status_code=400, detail="lat and lng must be given together")
+    
+    now = utc_now()
+    duties = await guard_duties_in_bucket(hour_bucket(now), wilaya, commune)
+    on_duty = {duty["pharmacy_id"]: duty["ends_at"] for duty in duties if duty["starts_at"] <= now < duty["ends_at"]}
+    
+    if lat is not None:
+        pharmacies = await find_nearby_pharmacies(
+            lat, lng, {"id": {"$in": list(on_duty)}}, limit, radius_km, endpoint="guard_now"
+        )
+    else:
+        documents = await db.pharmacies.find(
+            {"id": {"$in": list(on_duty)}}, PHARMACY_SUMMARY_PROJECTION
+        ).sort("id", ASCENDING).limit(limit).to_list(length=limit)
+        pharmacies = [
+            PharmacySummary(has_stock=medication_index.has_available_stock(document["id"]), **document)
+            for document in documents
+        ]
+    
+    return {
+        "as_of": now,
+        "pharmacies": [{**pharmacy.dict(), "on_duty_until": on_duty[pharmacy.id]} for pharmacy in pharmacies]
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -0,0 +1,430 @@
+"""Local load test and latency benchmark for the Pharmacy Platform API.
+
+Runs backend/server.py in-process against a local MongoDB (or an in-memory
+stand-in with --in-memory, which needs mongomock-motor), seeds a synthetic
+dataset, drives concurrent traffic at each endpoint and reports p50/p95/p99
+latency and throughput. Chat endpoints talk to a local fake OpenAI-compatible
+server, so no API key or network access is needed.
+
+    python backend_benchmark.py --pharmacies 10000 --save-baseline bench_baseline.json
+    python backend_benchmark.py --pharmacies 10000 --baseline bench_baseline.json
+
+--serialization skips the load test and measures the CPU cost of encoding 1k
+results through FastAPI's validating response path versus LeanJSONResponse,
+and what grouping search results per pharmacy saves on top.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import requests
+
+WILAYAS = {
+    "Alger": (36.7538, 3.0588, ["Alger Centre", "Hydra", "El Mouradia", "Bab El Oued", "Hussein Dey"]),
+    "Oran": (35.6976, -0.6337, ["Oran", "Es Sénia", "Bir El Djir"]),
+    "Constantine": (36.3650, 6.6147, ["Constantine", "El Khroub", "Ain Smara", "Hamma Bouziane"]),
+    "Annaba": (36.9000, 7.7667, ["Annaba", "El Bouni", "Sidi Amar"]),
+    "Blida": (36.4700, 2.8300, ["Blida", "Boufarik", "Ouled Yaïch"]),
+    "Sétif": (36.1900, 5.4100, ["Sétif", "El Eulma", "Ain Arnat"]),
+}
+MOLECULES = [
+    "Paracétamol", "Doliprane", "Ibuprofène", "Amoxicilline", "Aspirine", "Augmentin", "Smecta",
+    "Spasfon", "Oméprazole", "Metformine", "Amlodipine", "Atorvastatine", "Ventoline", "Zyrtec",
+    "Levothyrox", "Kardégic", "Dafalgan", "Efferalgan", "Clamoxyl", "Voltarène", "Gaviscon",
+    "Fervex", "Toplexil", "Maxilase", "Humex", "Lamaline", "Inexium", "Bisoprolol", "Losartan",
+]
+DOSAGES = ["100mg", "250mg", "400mg", "500mg", "1000mg", "5mg", "10mg", "20mg", "sirop", "gélules"]
+CHAT_REPLY = "Oui, nous avons ce médicament en stock. Vous pouvez passer le récupérer en pharmacie."
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint with a fixed delay"""
+    delay = 0.5
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.delay)
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for word in CHAT_REPLY.split(" "):
+                chunk = {
+                    "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        payload = json.dumps({
+            "id": "bench", "object": "chat.completion", "created": 0, "model": "fake",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": CHAT_REPLY}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def generate_pharmacies(count, stock_size, seed=42):
+    """Synthetic pharmacies spread around the wilaya centers with realistic stock"""
+    rng = random.Random(seed)
+    catalog = [f"{molecule} {dosage}" for molecule in MOLECULES for dosage in DOSAGES]
+    for index in range(count):
+        wilaya = rng.choice(list(WILAYAS))
+        lat, lng, communes = WILAYAS[wilaya]
+        lat += rng.uniform(-0.15, 0.15)
+        lng += rng.uniform(-0.15, 0.15)
+        stock = []
+        for name in rng.sample(catalog, min(len(catalog), max(1, int(rng.gauss(stock_size, stock_size / 4))))):
+            quantity = rng.choice([0, 0, 1, 5, 10, 20, 50, 100])
+            stock.append({
+                "medication_name": name,
+                "quantity": quantity,
+                "price": round(rng.uniform(80, 2500), 2),
+                "available": quantity > 0,
+            })
+        yield {
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "name": f"Pharmacie {index:06d}",
+            "phone": f"0{rng.randint(21, 49)}-{rng.randint(100, 999)}-{rng.randint(100, 999)}",
+            "location": {
+                "lat": lat, "lng": lng,
+                "address": f"{rng.randint(1, 200)} Rue {rng.choice(MOLECULES)}, {wilaya}",
+                "wilaya": wilaya, "commune": rng.choice(communes), "quartier": None,
+                "geo": {"type": "Point", "coordinates": [lng, lat]},
+            },
+            "is_guard": rng.random() < 0.1,
+            "stock": stock,
+            "subscription_active": rng.random() < 0.8,
+        }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    position = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[position]
+
+
+class PharmacyBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.port = args.port
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.results = {}
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency * 2))
+
+    def start_fake_llm(self):
+        FakeLLMHandler.delay = self.args.llm_delay
+        llm_server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLLMHandler)
+        threading.Thread(target=llm_server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{llm_server.server_address[1]}/v1"
+
+    def start_server(self):
+        """Import server.py with benchmark settings and serve it from a background thread"""
+        os.environ["MONGO_URL"] = self.args.mongo_url
+        os.environ["DB_NAME"] = self.args.db_name
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["OPENAI_BASE_URL"] = self.start_fake_llm()
+        # All traffic comes from one address; measure the server, not the per-client limiter
+        os.environ.setdefault("API_RATE_LIMIT", "0")
+        os.environ.setdefault("CHAT_RATE_LIMIT", "0")
+        if self.args.in_memory:
+            import mongomock_motor
+            import motor.motor_asyncio
+            motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+        import server
+        import uvicorn
+
+        self.server = server
+        self.loop = asyncio.new_event_loop()
+        self.uvicorn = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        threading.Thread(target=self.loop.run_until_complete, args=(self.uvicorn.serve(),), daemon=True).start()
+        while not self.uvicorn.started:
+            time.sleep(0.05)
+
+    def run_in_server_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def seed(self):
+        """Replace the benchmark database's pharmacies with a synthetic dataset"""
+        db = self.server.db
+        await db.pharmacies.delete_many({})
+        batch = []
+        for pharmacy in generate_pharmacies(self.args.pharmacies, self.args.stock_size):
+            batch.append(pharmacy)
+            if len(batch) == 1000:
+                await db.pharmacies.insert_many(batch)
+                batch = []
+        if batch:
+            await db.pharmacies.insert_many(batch)
+        await self.server.ensure_indexes()
+        await self.server.rebuild_medication_index()
+        self.server.pharmacy_cache.clear()
+        self.server.chat_cache.clear()
+        return [p["id"] async for p in db.pharmacies.find({"subscription_active": True}, {"_id": 0, "id": 1}).limit(500)]
+
+    def request_factories(self, pharmacy_ids):
+        rng = random.Random(7)
+        wilayas = list(WILAYAS)
+        queries = ["para", "doliprane", "ibuprofene", "amox", "smecta 500", "ventoline"]
+
+        def pick(values):
+            return values[rng.randrange(len(values))]
+
+        scenarios = {
+            "list_summary": lambda: ("GET", "/api/pharmacies", {"params": {"wilaya": pick(wilayas), "summary": "true"}}),
+            "list_medication": lambda: ("GET", "/api/pharmacies", {"params": {"medication": pick(queries), "summary": "true"}}),
+            "pharmacy_detail": lambda: ("GET", f"/api/pharmacies/{pick(pharmacy_ids)}", {}),
+            "search_medication": lambda: ("POST", "/api/search-medication", {"json": {"medication_name": pick(queries), "wilaya": pick(wilayas)}}),
+            "chat": lambda: ("POST", f"/api/chat/{pick(pharmacy_ids)}", {"params": {"message": f"Avez-vous du {pick(queries)} ?", "user_id": "bench"}}),
+        }
+        if not self.args.in_memory:
+            # mongomock has no $geoNear
+            scenarios["nearby"] = lambda: ("GET", "/api/pharmacies/nearby", {"params": {
+                "lat": WILAYAS["Alger"][0], "lng": WILAYAS["Alger"][1], "medication": pick(queries), "limit": 20,
+            }})
+        return scenarios
+
+    def call(self, factory):
+        method, path, kwargs = factory()
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=60, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def drive(self, factory, total, concurrency):
+        """Send `total` requests with `concurrency` workers; return latency stats"""
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(lambda _: self.call(factory), range(total)))
+        elapsed = time.perf_counter() - started
+        latencies = sorted(latency * 1000 for latency, _ in samples)
+        return {
+            "requests": total,
+            "errors": sum(1 for _, ok in samples if not ok),
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "mean_ms": round(statistics.fmean(latencies), 2) if latencies else 0.0,
+            "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        }
+
+    def log_result(self, name, stats):
+        self.results[name] = stats
+        status_icon = "✅" if stats["errors"] == 0 else "❌"
+        print(f"{status_icon} {name:<28} p50 {stats['p50_ms']:>8.2f} ms  p95 {stats['p95_ms']:>8.2f} ms  "
+              f"p99 {stats['p99_ms']:>8.2f} ms  {stats['throughput_rps']:>8.1f} req/s  errors {stats['errors']}")
+
+    def run(self):
+        print("🏁 Starting Pharmacy Platform Backend Benchmark")
+        print("=" * 100)
+        self.start_server()
+        started = time.perf_counter()
+        pharmacy_ids = self.run_in_server_loop(self.seed())
+        print(f"Seeded {self.args.pharmacies} pharmacies (~{self.args.stock_size} stock items each) "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        scenarios = self.request_factories(pharmacy_ids)
+        selected = self.args.endpoints or list(scenarios)
+        for name in selected:
+            total = self.args.chat_requests if name == "chat" else self.args.requests
+            self.log_result(name, self.drive(scenarios[name], total, self.args.concurrency))
+
+        if "chat" in scenarios and "search_medication" in selected:
+            # Search latency while chats are waiting on the model should stay flat
+            with ThreadPoolExecutor(max_workers=1) as background:
+                chats = background.submit(self.drive, scenarios["chat"], self.args.chat_requests, self.args.concurrency)
+                time.sleep(min(0.2, self.args.llm_delay / 2))
+                self.log_result("search_during_chat", self.drive(scenarios["search_medication"], self.args.requests, self.args.concurrency))
+                chats.result()
+
+        self.uvicorn.should_exit = True
+        print("=" * 100)
+        return self.results
+
+
+def cpu_ms(render, repeat):
+    """Median CPU milliseconds of render() over repeat runs"""
+    timings = []
+    for _ in range(repeat):
+        started = time.process_time()
+        render()
+        timings.append((time.process_time() - started) * 1000)
+    return statistics.median(timings)
+
+
+def serialization_benchmark(args):
+    """Compare validated and lean serialization of 1k list and search results"""
+    os.environ.setdefault("MONGO_URL", args.mongo_url)
+    os.environ.setdefault("DB_NAME", args.db_name)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import server
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    documents = []
+    for pharmacy in generate_pharmacies(1000, args.stock_size):
+        pharmacy["location"].pop("geo")
+        pharmacy["created_at"] = datetime.now()
+        documents.append(pharmacy)
+    list_field = create_response_field("Response", List[server.Pharmacy])
+
+    def validated_list():
+        # What a response_model endpoint does: build models, re-validate them, encode
+        models = [server.Pharmacy(**document) for document in documents]
+        content = asyncio.run(serialize_response(field=list_field, response_content=models, is_coroutine=True))
+        return JSONResponse(content).body
+
+    def lean_list():
+        return server.LeanJSONResponse(documents).body
+
+    # 1k matching stock items over 100 pharmacies, as the search aggregate returns
+    # them: the pharmacy fields without stock, plus its ten matching items
+    found = [
+        {**{field: value for field, value in document.items() if field != "stock"}, "stock": document["stock"][:10]}
+        for document in documents[:100]
+    ]
+
+    def summary(pharmacy):
+        return {field: value for field, value in pharmacy.items() if field != "stock"}
+
+    def grouped_results(pharmacies):
+        # What search_medication returns: each pharmacy once, with its matches
+        return [
+            {
+                "pharmacy": summary(pharmacy),
+                "matches": [{"stock_item": stock_item, "score": 1.0} for stock_item in pharmacy["stock"]],
+                "score": 1.0,
+                "distance_km": None,
+            }
+            for pharmacy in pharmacies
+        ]
+
+    def flat_results(pharmacies):
+        # One entry per matching item, repeating the pharmacy each time
+        return [
+            {"pharmacy": summary(pharmacy), "stock_item": stock_item, "score": 1.0, "distance_km": None}
+            for pharmacy in pharmacies for stock_item in pharmacy["stock"]
+        ]
+
+    def validated_search():
+        # The same grouped payload, built from models and encoded by FastAPI
+        results = [
+            {
+                "pharmacy": server.Pharmacy(**summary(pharmacy)).dict(exclude={"stock"}),
+                "matches": [{"stock_item": server.PharmacyStock(**stock_item), "score": 1.0} for stock_item in pharmacy["stock"]],
+                "score": 1.0,
+                "distance_km": None,
+            }
+            for pharmacy in found
+        ]
+        return JSONResponse(jsonable_encoder({"results": results, "total_found": 1000})).body
+
+    def lean_search():
+        return server.LeanJSONResponse({"results": grouped_results(found), "total_found": 1000}).body
+
+    def flat_search():
+        return server.LeanJSONResponse({"results": flat_results(found), "total_found": 1000}).body
+
+    encoder = "orjson" if server.orjson is not None else "json"
+    print(f"🧪 CPU per 1k results, median of {args.requests} runs (LeanJSONResponse uses {encoder})")
+    for name, before_name, before_render, after_name, after_render in [
+        ("list_pharmacies", "validated", validated_list, "lean", lean_list),
+        ("search_medication", "validated", validated_search, "lean", lean_search),
+        # Both lean: what grouping matches per pharmacy saves on its own
+        ("search_grouping", "flat", flat_search, "grouped", lean_search),
+    ]:
+        before = cpu_ms(before_render, args.requests)
+        after = cpu_ms(after_render, args.requests)
+        print(f"   {name:<20} {before_name:>9} {before:8.2f} ms   {after_name:>7} {after:8.2f} ms   "
+              f"saved {before - after:8.2f} ms ({(before - after) / before:.0%})   "
+              f"size {len(before_render()) / 1024:.0f} KiB -> {len(after_render()) / 1024:.0f} KiB")
+
+
+def compare(results, baseline, tolerance):
+    """Print p95/throughput changes against a baseline; return the regressed endpoints"""
+    regressions = []
+    print(f"📊 Comparison against baseline (tolerance {tolerance:.0%})")
+    for name, stats in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            print(f"   {name:<28} no baseline")
+            continue
+        p95_change = (stats["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] if previous["p95_ms"] else 0.0
+        rps_change = (stats["throughput_rps"] - previous["throughput_rps"]) / previous["throughput_rps"] if previous["throughput_rps"] else 0.0
+        regressed = p95_change > tolerance or rps_change < -tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{'⚠️ ' if regressed else '   '}{name:<28} p95 {p95_change:+.1%}  throughput {rps_change:+.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pharmacies", type=int, default=1000, help="synthetic pharmacies to seed (1k to 100k)")
+    parser.add_argument("--stock-size", type=int, default=80, help="mean stock items per pharmacy")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--chat-requests", type=int, default=40, help="requests for the chat endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--llm-delay", type=float, default=0.5, help="seconds the fake LLM takes to answer")
+    parser.add_argument("--endpoints", nargs="*", help="subset of scenarios to run")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="pharmacy_benchmark", help="database that is wiped and reseeded")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of MongoDB")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--save-baseline", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95/throughput regression ratio")
+    parser.add_argument("--serialization", action="store_true", help="run the serialization microbenchmark only")
+    args = parser.parse_args()
+
+    if args.serialization:
+        serialization_benchmark(args)
+        return 0
+
+    results = PharmacyBenchmark(args).run()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"⚠️  Regressions: {', '.join(regressions)}")
+            return 1
+        print("🎉 No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import { Search, MapPin, Phone, Clock, MessageCircle, Upload, Camera, AlertCircle } from 'lucide-react';
 import { Button } from './components/ui/button';
@@ -14,6 +14,18 @@ import './App.css';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL;
 
+// Fetch one page of pharmacies; the next page's cursor comes back in X-Next-Cursor
+const fetchPharmacyPage = async ({ wilaya, commune, medication }, cursor) => {
+  const params = new URLSearchParams({ summary: 'true' });
+  if (wilaya) params.append('wilaya', wilaya);
+  if (commune) params.append('commune', commune);
+  if (medication) params.append('medication', medication);
+  if (cursor) params.append('cursor', cursor);
+
+  const response = await axios.get(`${API_BASE_URL}/api/pharmacies?${params}`);
+  return { items: response.data, cursor: response.headers['x-next-cursor'] || null };
+};
+
 function App() {
   const [pharmacies, setPharmacies] = useState([]);
   const [filteredPharmacies, setFilteredPharmacies] = useState([]);
@@ -23,7 +35,10 @@ function App() {
   const [selectedCommune, setSelectedCommune] = useState('');
   const [chatMessage, setChatMessage] = useState('');
   const [chatResponse, setChatResponse] = useState('');
+  const [conversationId, setConversationId] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
   const [prescriptionFile, setPrescriptionFile] = useState(null);
 
   // Algeria locations data
@@ -39,40 +54,116 @@ function App() {
   // Current token is secret token (sk.*) which cannot be used in frontend
 
   // Fetch pharmacies
+  const filters = { wilaya: selectedWilaya, commune: selectedCommune, medication: searchQuery };
+  const filtersKey = useRef('');
+  filtersKey.current = JSON.stringify(filters);
   useEffect(() => {
+    let cancelled = false;
     const fetchPharmacies = async () => {
       try {
         setIsLoading(true);
-        const params = new URLSearchParams();
-        if (selectedWilaya) params.append('wilaya', selectedWilaya);
-        if (selectedCommune) params.append('commune', selectedCommune);
-        if (searchQuery) params.append('medication', searchQuery);
-
-        const response = await axios.get(`${API_BASE_URL}/api/pharmacies?${params}`);
-        setPharmacies(response.data);
-        setFilteredPharmacies(response.data);
+        const page = await fetchPharmacyPage(
+          { wilaya: selectedWilaya, commune: selectedCommune, medication: searchQuery },
+          null
+        );
+        if (cancelled) return;
+        setPharmacies(page.items);
+        setFilteredPharmacies(page.items);
+        setNextCursor(page.cursor);
       } catch (error) {
         console.error('Error fetching pharmacies:', error);
       } finally {
-        setIsLoading(false);
+        if (!cancelled) setIsLoading(false);
       }
     };
 
     fetchPharmacies();
+    return () => { cancelled = true; };
   }, [selectedWilaya, selectedCommune, searchQuery]);
 
+  const handleLoadMore = async () => {
+    if (!nextCursor || isLoadingMore) return;
+    try {
+      setIsLoadingMore(true);
+      const requestedKey = filtersKey.current;
+      const page = await fetchPharmacyPage(filters, nextCursor);
+      if (requestedKey !== filtersKey.current) return;
+      setPharmacies(previous => [...previous, ...page.items]);
+      setFilteredPharmacies(previous => [...previous, ...page.items]);
+      setNextCursor(page.cursor);
+    } catch (error) {
+      console.error('Error fetching more pharmacies:', error);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
+  // Reload the open pharmacy when the server pushes a stock change for it
+  useEffect(() => {
+    if (!selectedPharmacy?.id) return undefined;
+    const events = new EventSource(`${API_BASE_URL}/api/events?pharmacy_id=${selectedPharmacy.id}`);
+    events.addEventListener('stock', async () => {
+      try {
+        const response = await axios.get(`${API_BASE_URL}/api/pharmacies/${selectedPharmacy.id}`);
+        setSelectedPharmacy(response.data);
+      } catch (error) {
+        console.error('Error refreshing pharmacy stock:', error);
+      }
+    });
+    return () => events.close();
+  }, [selectedPharmacy?.id]);
+
+  // The list only carries summaries; load stock when a pharmacy is opened
+  const handleSelectPharmacy = async (pharmacy) => {
+    setSelectedPharmacy(pharmacy);
+    // A new chat session per opened pharmacy; the backend replays its recent turns
+    setConversationId(crypto.randomUUID());
+    try {
+      const response = await axios.get(`${API_BASE_URL}/api/pharmacies/${pharmacy.id}`);
+      setSelectedPharmacy(response.data);
+    } catch (error) {
+      console.error('Error fetching pharmacy details:', error);
+    }
+  };
+
   const handleChatSubmit = async () => {
     if (!chatMessage.trim() || !selectedPharmacy) return;
 
     try {
       setIsLoading(true);
-      const response = await axios.post(`${API_BASE_URL}/api/chat/${selectedPharmacy.id}`, null, {
-        params: {
-          message: chatMessage,
-          user_id: 'user_123' // In real app, this would be authenticated user ID
-        }
+      setChatResponse('');
+      const params = new URLSearchParams({
+        message: chatMessage,
+        user_id: 'user_123', // In real app, this would be authenticated user ID
+        conversation_id: conversationId
+      });
+      const response = await fetch(`${API_BASE_URL}/api/chat/${selectedPharmacy.id}/stream?${params}`, {
+        method: 'POST'
       });
-      setChatResponse(response.data.response);
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+
+      // Append tokens as they arrive over Server-Sent Events
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      for (;;) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
+        for (const frame of frames) {
+          const event = frame.match(/^event: (.*)$/m)?.[1];
+          const data = frame.match(/^data: (.*)$/m)?.[1];
+          if (!data) continue;
+          const payload = JSON.parse(data);
+          if (event === 'token') {
+            setChatResponse(previous => previous + payload.token);
+          } else if (event === 'error') {
+            setChatResponse(payload.detail);
+          }
+        }
+      }
       setChatMessage('');
     } catch (error) {
       console.error('Error sending chat message:', error);
@@ -82,12 +173,23 @@ function App() {
     }
   };
 
-  const handlePrescriptionUpload = (event) => {
+  const handlePrescriptionUpload = async (event) => {
     const file = event.target.files[0];
-    if (file) {
-      setPrescriptionFile(file);
-      // In a real app, you would process the file with OCR here
-      console.log('Prescription file uploaded:', file.name);
+    if (!file) return;
+    setPrescriptionFile(file);
+    if (!selectedPharmacy) return;
+
+    try {
+      // The image is sent as the raw body; medications are extracted server-side
+      const params = new URLSearchParams({
+        user_id: 'user_123', // In real app, this would be authenticated user ID
+        pharmacy_id: selectedPharmacy.id
+      });
+      await axios.post(`${API_BASE_URL}/api/prescriptions/upload?${params}`, file, {
+        headers: { 'Content-Type': file.type }
+      });
+    } catch (error) {
+      console.error('Error uploading prescription:', error);
     }
   };
 
@@ -241,7 +343,7 @@ function App() {
                           ? 'border-emerald-500 bg-emerald-50'
                           : 'border-gray-200 hover:border-emerald-300 hover:bg-emerald-25'
                       }`}
-                      onClick={() => setSelectedPharmacy(pharmacy)}
+                      onClick={() => handleSelectPharmacy(pharmacy)}
                     >
                       <div className="flex items-start justify-between">
                         <div className="flex-1">
@@ -259,13 +361,23 @@ function App() {
                             </Badge>
                           )}
                           <div className={`w-3 h-3 rounded-full ${
-                            pharmacy.stock?.some(item => item.available) ? 'bg-green-500' : 'bg-red-500'
+                            pharmacy.has_stock ? 'bg-green-500' : 'bg-red-500'
                           }`} />
                         </div>
                       </div>
                     </div>
                   ))
                 )}
+                {!isLoading && nextCursor && (
+                  <Button
+                    onClick={handleLoadMore}
+                    disabled={isLoadingMore}
+                    variant="outline"
+                    className="w-full border-emerald-200 text-emerald-700 hover:bg-emerald-50"
+                  >
+                    {isLoadingMore ? 'Chargement...' : 'Charger plus'}
+                  </Button>
+                )}
               </CardContent>
             </Card>
           </div>
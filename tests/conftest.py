@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The API is a single module in backend/, imported as `server`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
@@ -0,0 +1,203 @@
+import asyncio
+import ipaddress
+import time
+
+import pytest
+
+import server
+from server import AdmissionControlMiddleware, AdmissionGate, TokenBucketLimiter
+
+
+class FakeClock:
+    """Stands in for the time module in server, so the event loop keeps the real clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "time", clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_asks_to_wait(clock):
+    limiter = TokenBucketLimiter(rate=2, burst=3)
+    assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire("a") == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_rate(clock):
+    limiter = TokenBucketLimiter(rate=2, burst=1)
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("a") > 0
+    clock.now += 0.5
+    assert limiter.acquire("a") == 0.0
+
+
+def test_buckets_are_per_client(clock):
+    limiter = TokenBucketLimiter(rate=1, burst=1)
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("b") == 0.0
+    assert limiter.acquire("a") > 0
+
+
+def test_zero_rate_disables_the_limiter(clock):
+    limiter = TokenBucketLimiter(rate=0, burst=0)
+    assert all(limiter.acquire("a") == 0.0 for _ in range(100))
+
+
+def test_gate_rejects_at_once_when_the_queue_is_full():
+    async def scenario():
+        gate = AdmissionGate("test", limit=1, max_queue=0, timeout=5)
+        assert await gate.enter()
+        assert not await gate.enter()
+        gate.leave()
+        assert await gate.enter()
+    asyncio.run(scenario())
+
+
+def test_gate_rejects_after_the_queue_timeout():
+    async def scenario():
+        gate = AdmissionGate("test", limit=1, max_queue=1, timeout=0.05)
+        assert await gate.enter()
+        assert not await gate.enter()
+        assert gate.waiting == 0
+    asyncio.run(scenario())
+
+
+def test_gate_hands_a_released_slot_to_a_waiter():
+    async def scenario():
+        gate = AdmissionGate("test", limit=1, max_queue=1, timeout=1)
+        assert await gate.enter()
+        waiter = asyncio.create_task(gate.enter())
+        await asyncio.sleep(0.01)
+        gate.leave()
+        assert await waiter
+        assert gate.active == 1
+    asyncio.run(scenario())
+
+
+async def call(app, path="/api/pharmacies", client="203.0.113.9", headers=()):
+    """Run one request through an ASGI app; returns (status, headers), or None if nothing was sent"""
+    scope = {
+        "type": "http", "method": "GET", "path": path, "client": (client, 50000),
+        "headers": [(name.encode(), value.encode()) for name, value in headers],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    if not messages:
+        return None
+    start = messages[0]
+    return start["status"], dict(start.get("headers", []))
+
+
+async def ok(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+@pytest.fixture
+def admission(monkeypatch, clock):
+    monkeypatch.setattr(server, "trusted_proxy_networks", [ipaddress.ip_network("10.0.0.0/8")])
+    monkeypatch.setitem(server.rate_limiters, "api", TokenBucketLimiter(rate=1, burst=2))
+    monkeypatch.setitem(server.admission_gates, "api", AdmissionGate("api", limit=1, max_queue=0, timeout=1))
+
+
+def test_rate_limited_client_gets_429_with_retry_after(admission):
+    async def scenario():
+        app = AdmissionControlMiddleware(ok)
+        statuses = [(await call(app))[0] for _ in range(2)]
+        status, headers = await call(app)
+        return statuses, status, headers
+    statuses, status, headers = asyncio.run(scenario())
+    assert statuses == [200, 200]
+    assert status == 429
+    assert headers[b"retry-after"] == b"1"
+
+
+def test_clients_behind_a_trusted_proxy_get_their_own_buckets(admission):
+    async def scenario():
+        app = AdmissionControlMiddleware(ok)
+        return [
+            (await call(app, client="10.0.0.2", headers=[("x-forwarded-for", f"198.51.100.{i}, 10.0.0.7")]))[0]
+            for i in range(45)
+        ]
+    assert set(asyncio.run(scenario())) == {200}
+
+
+def test_forwarded_for_from_untrusted_peers_is_ignored(admission):
+    async def scenario():
+        app = AdmissionControlMiddleware(ok)
+        return [
+            (await call(app, client="203.0.113.9", headers=[("x-forwarded-for", f"198.51.100.{i}")]))[0]
+            for i in range(3)
+        ]
+    assert asyncio.run(scenario()) == [200, 200, 429]
+
+
+def test_rate_limits_are_off_without_trusted_proxies(admission, monkeypatch):
+    monkeypatch.setattr(server, "trusted_proxy_networks", None)
+
+    async def scenario():
+        app = AdmissionControlMiddleware(ok)
+        return [(await call(app))[0] for _ in range(5)]
+    assert set(asyncio.run(scenario())) == {200}
+
+
+def test_saturated_route_class_gets_503(admission):
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow(scope, receive, send):
+            await release.wait()
+            await ok(scope, receive, send)
+
+        app = AdmissionControlMiddleware(slow)
+        first = asyncio.create_task(call(app, client="203.0.113.1"))
+        await asyncio.sleep(0.01)
+        status, headers = await call(app, client="203.0.113.2")
+        release.set()
+        return status, headers, (await first)[0]
+    status, headers, first_status = asyncio.run(scenario())
+    assert status == 503
+    assert b"retry-after" in headers
+    assert first_status == 200
+
+
+def test_slot_is_released_when_the_client_disconnects(admission):
+    async def scenario():
+        async def until_disconnect(scope, receive, send):
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        async def forever(scope, receive, send):
+            await asyncio.Event().wait()
+
+        gate = server.admission_gates["api"]
+        assert await call(AdmissionControlMiddleware(until_disconnect)) is None
+        assert gate.active == 0
+        
+        # A handler cancelled mid-request (e.g. the server shutting down) releases too
+        task = asyncio.create_task(call(AdmissionControlMiddleware(forever), client="203.0.113.3"))
+        await asyncio.sleep(0.01)
+        assert gate.active == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert gate.active == 0
+    asyncio.run(scenario())
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def db(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test_pharmacy_platform"]
+    monkeypatch.setattr(server, "db", db)
+    return db
+
+
+def snapshot(revision, names):
+    return {
+        "id": "p1", "stock_revision": revision,
+        "location": {"wilaya": "Alger", "commune": "Alger"},
+        "stock": [{"medication_name": name, "quantity": 5, "price": 100.0, "available": True} for name in names],
+    }
+
+
+async def available(db):
+    return {row["medication"] async for row in db.medication_availability.find({})}
+
+
+def test_an_older_snapshot_processed_last_is_skipped(db):
+    async def scenario():
+        await db.pharmacies.insert_one(snapshot(2, ["doliprane"]))
+        # Revision 1 added amoxicilline, revision 2 removed it again; 2 is applied first
+        await server.update_medication_availability([snapshot(2, ["doliprane"])])
+        await server.update_medication_availability([snapshot(1, ["doliprane", "amoxicilline"])])
+        return await available(db)
+    assert asyncio.run(scenario()) == {"doliprane"}
+
+
+def test_a_snapshot_outdated_while_applied_is_redone(db):
+    async def scenario():
+        await db.pharmacies.insert_one(snapshot(2, ["doliprane"]))
+        # Revision 2 is already stored but its update has not run yet
+        await server.update_medication_availability([snapshot(1, ["doliprane", "amoxicilline"])])
+        offers = {offer["medication"]: offer async for offer in db.medication_offers.find({})}
+        return await available(db), offers
+    medications, offers = asyncio.run(scenario())
+    assert medications == {"doliprane"}
+    assert offers["amoxicilline"]["available"] is False
+    assert offers["amoxicilline"]["revision"] == 2
+
+
+def test_only_one_worker_holds_the_rebuild_lock(db):
+    async def scenario():
+        first = await server.acquire_maintenance_lock("medication_availability")
+        second = await server.acquire_maintenance_lock("medication_availability")
+        await server.release_maintenance_lock("medication_availability")
+        third = await server.acquire_maintenance_lock("medication_availability")
+        return first, second, third
+    assert asyncio.run(scenario()) == (True, False, True)
+
+
+def test_an_expired_rebuild_lock_is_taken_over(db):
+    async def scenario():
+        await server.acquire_maintenance_lock("medication_availability")
+        await db.maintenance_locks.update_one({}, {"$set": {"expires_at": server.datetime(2000, 1, 1, tzinfo=server.timezone.utc)}})
+        return await server.acquire_maintenance_lock("medication_availability")
+    assert asyncio.run(scenario()) is True
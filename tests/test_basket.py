@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import server
+from server import basket_candidates, cover_basket
+
+
+def offer(price):
+    return {"medication_name": "x", "price": price, "quantity": 1, "available": True}
+
+
+OFFERS = {
+    "a": {0: offer(100), 1: offer(100), 2: offer(100)},
+    "b": {0: offer(90)},
+    "c": {1: offer(90)},
+}
+
+
+def test_fewest_stops_covers_every_item_with_few_pharmacies():
+    assert cover_basket(OFFERS, [0, 1, 2], "fewest_stops", {}) == {0: "a", 1: "a", 2: "a"}
+
+
+def test_fewest_stops_buys_at_the_cheapest_chosen_pharmacy():
+    offers = {"a": {0: offer(100), 1: offer(300)}, "b": {1: offer(200), 2: offer(50)}, "c": {0: offer(90)}}
+    # b covers two items for less than a, then c is cheaper than a for the last one
+    assert cover_basket(offers, [0, 1, 2], "fewest_stops", {}) == {0: "c", 1: "b", 2: "b"}
+
+
+def test_cheapest_buys_every_item_where_it_costs_least():
+    assert cover_basket(OFFERS, [0, 1, 2], "cheapest", {}) == {0: "b", 1: "c", 2: "a"}
+
+
+def test_items_no_pharmacy_has_are_left_out():
+    assignment = cover_basket(OFFERS, [0, 1, 2, 3], "fewest_stops", {})
+    assert 3 not in assignment
+    assert len(assignment) == 3
+
+
+def test_fewest_stops_prefers_the_cheaper_then_nearer_pharmacy_on_ties():
+    offers = {"far": {0: offer(100)}, "near": {0: offer(100)}, "cheap": {0: offer(80)}}
+    assert cover_basket(offers, [0], "fewest_stops", {"far": 5.0, "near": 1.0, "cheap": 9.0}) == {0: "cheap"}
+    del offers["cheap"]
+    assert cover_basket(offers, [0], "fewest_stops", {"far": 5.0, "near": 1.0}) == {0: "near"}
+
+
+def test_cheapest_prefers_the_nearer_pharmacy_at_equal_price():
+    offers = {"far": {0: offer(100)}, "near": {0: offer(100)}}
+    assert cover_basket(offers, [0], "cheapest", {"far": 5.0, "near": 1.0}) == {0: "near"}
+
+
+def test_candidates_keep_the_only_pharmacy_with_a_rare_item():
+    coverage = {"p1": {0, 1}, "p2": {0, 1}, "p3": {0, 1}, "rare": {2}}
+    assert set(basket_candidates(coverage, {}, 2)) == {"p1", "rare"}
+
+
+def test_candidates_fill_up_by_items_covered_then_distance():
+    coverage = {"one": {0}, "two_far": {0, 1}, "two_near": {0, 1}}
+    assert basket_candidates(coverage, {"two_far": 9.0, "two_near": 1.0, "one": 0.5}, 3) == ["two_near", "two_far", "one"]
+    assert basket_candidates(coverage, {}, 1) == ["two_far"]
+
+
+def test_basket_finds_items_beyond_the_first_candidates(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    httpx = pytest.importorskip("httpx")
+    db = mongomock_motor.AsyncMongoMockClient()["test_pharmacy_platform"]
+    monkeypatch.setattr(server, "db", db)
+    index = server.MedicationIndex()
+    monkeypatch.setattr(server, "medication_index", index)
+    
+    def pharmacy(pharmacy_id, names):
+        stock = [{"medication_name": name, "quantity": 5, "price": 100.0, "available": True} for name in names]
+        index.replace_pharmacy(pharmacy_id, stock)
+        return {
+            "id": pharmacy_id, "name": pharmacy_id, "phone": "0", "is_guard": False, "subscription_active": True,
+            "location": {"lat": 36.7, "lng": 3.0, "address": "", "wilaya": "Alger", "commune": "Alger", "quartier": ""},
+            "stock": stock,
+        }
+
+    async def scenario():
+        await db.pharmacies.insert_many(
+            [pharmacy(f"a{i}", ["Paracétamol 500mg"]) for i in range(5)] + [pharmacy("z", ["Doliprane 1000mg"])]
+        )
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as api:
+            response = await api.post("/api/basket", json={
+                "medications": ["Paracétamol 500mg", "Doliprane 1000mg"], "candidates": 2
+            })
+        return response.json()
+    result = asyncio.run(scenario())
+    assert result["missing"] == []
+    assert result["covered"] == 2
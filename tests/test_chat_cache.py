@@ -0,0 +1,21 @@
+import server
+from server import Pharmacy, chat_cache_key
+
+
+def pharmacy(quantity):
+    return Pharmacy(
+        id="p1", name="Pharmacie Hydra", phone="0",
+        location={"lat": 36.7, "lng": 3.1, "address": "Hydra", "wilaya": "Alger", "commune": "Hydra", "quartier": "Hydra"},
+        stock=[{"medication_name": "Doliprane 1000mg", "quantity": quantity, "price": 180.0, "available": quantity > 0}],
+    )
+
+
+def test_the_same_question_against_the_same_stock_shares_a_key():
+    assert chat_cache_key(pharmacy(5), "Avez-vous du Doliprane ?") == chat_cache_key(pharmacy(5), "avez vous du doliprane")
+
+
+def test_a_stock_change_moves_answers_to_a_new_key(monkeypatch):
+    monkeypatch.setattr(server, "medication_index", server.MedicationIndex())
+    cached = chat_cache_key(pharmacy(5), "Avez-vous du Doliprane ?")
+    server.refresh_local_pharmacy_state("p1", [{"medication_name": "Doliprane 1000mg", "quantity": 0, "price": 180.0, "available": False}])
+    assert chat_cache_key(pharmacy(0), "Avez-vous du Doliprane ?") != cached
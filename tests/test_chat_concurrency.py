@@ -0,0 +1,97 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+httpx = pytest.importorskip("httpx")
+uvicorn = pytest.importorskip("uvicorn")
+
+from fastapi import FastAPI  # noqa: E402
+from openai import AsyncOpenAI  # noqa: E402
+
+import server  # noqa: E402
+
+LLM_DELAY = 2.0
+
+fake_llm = FastAPI()
+
+
+@fake_llm.post("/v1/chat/completions")
+async def completions():
+    """OpenAI-compatible endpoint that answers slowly, like a loaded model"""
+    await asyncio.sleep(LLM_DELAY)
+    return {
+        "id": "test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "test",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "Oui."}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+    }
+
+
+@pytest.fixture
+def fake_llm_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    llm_server = uvicorn.Server(uvicorn.Config(fake_llm, host="127.0.0.1", port=port, log_level="error"))
+    thread = threading.Thread(target=llm_server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not llm_server.started:
+        assert time.monotonic() < deadline, "fake LLM server did not start"
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}/v1"
+    llm_server.should_exit = True
+    thread.join(5)
+
+
+@pytest.fixture
+def app_state(monkeypatch, fake_llm_url):
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", client["test_pharmacy_platform"])
+    monkeypatch.setattr(server, "openai_client", AsyncOpenAI(api_key="test", base_url=fake_llm_url, max_retries=0))
+    monkeypatch.setitem(server.rate_limiters, "chat", server.TokenBucketLimiter(0, 0))
+    monkeypatch.setitem(server.rate_limiters, "api", server.TokenBucketLimiter(0, 0))
+    server.chat_cache.clear()
+    server.medication_index.clear()
+
+
+def test_search_stays_fast_while_chats_wait_on_the_llm(app_state):
+    async def scenario():
+        await server.startup_event()
+        try:
+            pharmacy = await server.db.pharmacies.find_one({}, {"_id": 0, "id": 1})
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as api:
+                chats = [
+                    asyncio.create_task(api.post(
+                        f"/api/chat/{pharmacy['id']}",
+                        params={"message": f"Avez-vous du Doliprane ? ({i})", "user_id": "test"}
+                    ))
+                    for i in range(5)
+                ]
+                await asyncio.sleep(0.3)
+                
+                started = time.perf_counter()
+                search = await api.post("/api/search-medication", json={"medication_name": "paracetamol"})
+                elapsed = time.perf_counter() - started
+                
+                assert not any(chat.done() for chat in chats), "chats should still be waiting on the LLM"
+                responses = await asyncio.gather(*chats)
+        finally:
+            await server.shutdown_event()
+        return search, elapsed, responses
+    
+    search, elapsed, responses = asyncio.run(scenario())
+    
+    assert search.status_code == 200
+    assert search.json()["total_found"] > 0
+    assert elapsed < 0.5, f"search took {elapsed:.3f}s while chats were pending"
+    assert all(response.status_code == 200 for response in responses)
+    assert all(response.json()["response"] == "Oui." for response in responses)
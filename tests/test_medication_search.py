@@ -0,0 +1,63 @@
+import pytest
+
+from server import MedicationIndex, medication_dosages, medication_tokens
+
+
+@pytest.fixture
+def index():
+    index = MedicationIndex()
+    index.replace_pharmacy("p1", [
+        {"medication_name": name, "available": True}
+        for name in [
+            "Paracétamol 500mg",
+            "Doliprane 1000mg",
+            "Doliprane 500mg",
+            "Ibuprofène 400mg",
+            "Bisoprolol 2,5mg",
+            "Bisoprolol 5mg",
+        ]
+    ])
+    index.replace_pharmacy("p2", [{"medication_name": "Amoxicilline 1g", "available": False}])
+    return index
+
+
+def ranked(index, query):
+    return [name for name, _ in sorted(index.search_names(query).items(), key=lambda item: -item[1])]
+
+
+def test_tokens_split_glued_dosages():
+    assert medication_tokens("doliprane1000mg") == ["doliprane", "1000", "mg"]
+
+
+def test_tokens_keep_decimal_dosages_whole():
+    assert medication_tokens("bisoprolol 2,5mg") == ["bisoprolol", "2.5", "mg"]
+    assert medication_dosages("Bisoprolol 2.5 mg") == {"2.5"}
+
+
+def test_typos_match(index):
+    assert ranked(index, "paracetmol")[0] == "paracetamol 500mg"
+    assert ranked(index, "ibuprofen")[0] == "ibuprofene 400mg"
+
+
+def test_synonyms_match(index):
+    assert ranked(index, "advil") == ["ibuprofene 400mg"]
+    assert "paracetamol 500mg" in ranked(index, "doliprane")
+
+
+def test_glued_dosage_ranks_exact_dosage_first(index):
+    assert ranked(index, "doliprane1000mg")[:2] == ["doliprane 1000mg", "doliprane 500mg"]
+
+
+def test_decimal_dosage_ranks_exact_dosage_first(index):
+    assert ranked(index, "bisoprolol 2,5 mg") == ["bisoprolol 2,5mg", "bisoprolol 5mg"]
+    assert ranked(index, "bisoprolol 2.5") == ["bisoprolol 2,5mg", "bisoprolol 5mg"]
+    assert ranked(index, "2.5") == ["bisoprolol 2,5mg"]
+
+
+def test_named_brand_outranks_synonym_with_the_dosage(index):
+    scores = index.search_names("dolipran 500")
+    assert scores["doliprane 1000mg"] > scores["paracetamol 500mg"]
+
+
+def test_unavailable_stock_is_not_indexed(index):
+    assert index.search_names("amoxicilline") == {}
@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import server
+from server import is_unbounded_scan, plan_stages
+
+ID_INDEX_SCAN = {
+    "stage": "FETCH",
+    "filter": {"location.quartier": {"$eq": "x"}},
+    "inputStage": {"stage": "IXSCAN", "indexName": "id_1", "indexBounds": {"id": ["[MinKey, MaxKey]"]}},
+}
+QUARTIER_INDEX_SCAN = {
+    "stage": "FETCH",
+    "inputStage": {
+        "stage": "IXSCAN", "indexName": "location.quartier_1_id_1",
+        "indexBounds": {"location.quartier": ['["x", "x"]'], "id": ["[MinKey, MaxKey]"]},
+    },
+}
+
+
+def test_a_full_index_scan_is_unbounded():
+    assert [is_unbounded_scan(stage) for stage in plan_stages(ID_INDEX_SCAN)] == [False, True]
+
+
+def test_a_scan_bounded_on_its_leading_field_is_not():
+    assert not any(is_unbounded_scan(stage) for stage in plan_stages(QUARTIER_INDEX_SCAN))
+
+
+class ExplainedCursor:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def sort(self, sort):
+        return self
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": self.plan}}
+
+
+class ExplainedCollection:
+    def __init__(self, plans):
+        self.plans = plans
+
+    def find(self, query):
+        # Only the quartier filter walks the id index; everything else is bounded
+        return ExplainedCursor(self.plans[0] if "location.quartier" in query else self.plans[1])
+
+
+def test_query_plans_fail_on_a_filtered_full_index_scan(monkeypatch):
+    collection = ExplainedCollection([ID_INDEX_SCAN, QUARTIER_INDEX_SCAN])
+    monkeypatch.setattr(server, "db", {name: collection for _, name, _, _ in server.QUERY_SHAPES})
+    response = asyncio.run(server.get_query_plans())
+    report = json.loads(response.body)
+    assert response.status_code == 503
+    assert report["collscans"] == []
+    assert report["unbounded_scans"] == ["list_pharmacies_by_quartier"]
+
+    collection.plans[0] = QUARTIER_INDEX_SCAN
+    assert asyncio.run(server.get_query_plans()).status_code == 200
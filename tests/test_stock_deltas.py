@@ -0,0 +1,50 @@
+import pytest
+
+from server import StockDelta, stock_delta_pipeline
+
+
+def apply(stock, *deltas):
+    mongomock = pytest.importorskip("mongomock")
+    pharmacies = mongomock.MongoClient()["test_pharmacy_platform"]["pharmacies"]
+    pharmacies.insert_one({"id": "p1", "stock": stock, "stock_revision": 4})
+    pharmacies.update_one({"id": "p1"}, stock_delta_pipeline(list(deltas)))
+    return pharmacies.find_one({"id": "p1"}, {"_id": 0})
+
+
+def item(name, quantity, price=100.0):
+    return {"medication_name": name, "quantity": quantity, "price": price, "available": quantity > 0}
+
+
+def test_a_sale_beyond_the_stock_floors_the_quantity_at_zero():
+    pharmacy = apply([item("Doliprane 1000mg", 3)], StockDelta(medication_name="Doliprane 1000mg", quantity_delta=-5))
+    assert pharmacy["stock"] == [item("Doliprane 1000mg", 0)]
+    assert pharmacy["stock"][0]["available"] is False
+    assert pharmacy["stock_revision"] == 5
+
+
+def test_a_delivery_makes_the_item_available_again():
+    pharmacy = apply([item("Doliprane 1000mg", 0)], StockDelta(medication_name="Doliprane 1000mg", quantity_delta=10, price=120.0))
+    assert pharmacy["stock"] == [item("Doliprane 1000mg", 10, 120.0)]
+
+
+def test_an_absolute_quantity_overrides_the_current_one():
+    pharmacy = apply([item("Doliprane 1000mg", 7)], StockDelta(medication_name="Doliprane 1000mg", quantity=0, quantity_delta=4))
+    assert pharmacy["stock"] == [item("Doliprane 1000mg", 0)]
+
+
+def test_an_unknown_medication_with_a_price_is_added():
+    pharmacy = apply([item("Doliprane 1000mg", 3)], StockDelta(medication_name="Amoxicilline 500mg", quantity_delta=6, price=80.0))
+    assert pharmacy["stock"] == [item("Doliprane 1000mg", 3), item("Amoxicilline 500mg", 6, 80.0)]
+
+
+def test_an_unknown_medication_without_a_price_is_left_out():
+    pharmacy = apply([item("Doliprane 1000mg", 3)], StockDelta(medication_name="Dolipran 1000mg", quantity_delta=-1))
+    assert pharmacy["stock"] == [item("Doliprane 1000mg", 3)]
+    assert pharmacy["stock_revision"] == 5
+
+
+def test_a_name_that_looks_like_a_field_path_is_taken_literally():
+    stock = [item("Doliprane 1000mg", 3)]
+    assert apply(stock, StockDelta(medication_name="$$item.medication_name", quantity_delta=-1))["stock"] == stock
+    pharmacy = apply(stock, StockDelta(medication_name="$stock", quantity_delta=2, price=10.0))
+    assert pharmacy["stock"] == stock + [item("$stock", 2, 10.0)]
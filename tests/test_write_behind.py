@@ -0,0 +1,186 @@
+import asyncio
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import server
+from server import WriteBehindBuffer
+
+
+class FakeCollection:
+    """insert_many stand-in recording batches; `fail` decides what each call does"""
+
+    def __init__(self):
+        self.batches = []
+        self.fail = None
+
+    async def insert_many(self, documents, ordered=True):
+        if self.fail:
+            await self.fail(documents)
+        self.batches.append([document["id"] for document in documents])
+
+    @property
+    def written(self):
+        return [document_id for batch in self.batches for document_id in batch]
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(server, "db", {"test": collection})
+    return collection
+
+
+def test_flushes_when_a_batch_is_full(collection):
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=3, interval=60, max_pending=100)
+        flusher = asyncio.create_task(buffer.run())
+        for i in range(3):
+            await buffer.add({"id": i})
+        await asyncio.sleep(0.05)
+        buffer.stop()
+        await flusher
+    asyncio.run(scenario())
+    assert collection.batches == [[0, 1, 2]]
+
+
+def test_flushes_every_interval(collection):
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=0.05, max_pending=100)
+        flusher = asyncio.create_task(buffer.run())
+        await buffer.add({"id": 1})
+        await asyncio.sleep(0.2)
+        written = list(collection.written)
+        buffer.stop()
+        await flusher
+        return written
+    assert asyncio.run(scenario()) == [1]
+
+
+def test_stop_flushes_what_is_left(collection):
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=100)
+        flusher = asyncio.create_task(buffer.run())
+        await buffer.add({"id": 1})
+        buffer.stop()
+        await asyncio.wait_for(flusher, 1)
+    asyncio.run(scenario())
+    assert collection.written == [1]
+
+
+def test_producers_wait_for_a_flush_when_the_buffer_is_full(collection):
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=2)
+        await buffer.add({"id": 1})
+        await buffer.add({"id": 2})
+        assert collection.written == []
+        await buffer.add({"id": 3})
+        return len(buffer)
+    assert asyncio.run(scenario()) == 1
+    assert collection.written == [1, 2]
+
+
+def test_waiting_add_returns_once_written(collection):
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=100)
+        await asyncio.gather(*(buffer.add({"id": i}, wait=True) for i in range(3)))
+    asyncio.run(scenario())
+    assert sorted(collection.written) == [0, 1, 2]
+
+
+def test_waiting_add_raises_for_a_rejected_document(collection):
+    async def reject_first(documents):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": 121, "errmsg": "validation"}]})
+    collection.fail = reject_first
+
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=100)
+        with pytest.raises(BulkWriteError):
+            await buffer.add({"id": 1}, wait=True)
+        return len(buffer)
+    assert asyncio.run(scenario()) == 0
+
+
+def test_connection_errors_keep_unwaited_documents(collection):
+    async def disconnect(documents):
+        raise AutoReconnect("down")
+    collection.fail = disconnect
+
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=100)
+        await buffer.add({"id": 1})
+        with pytest.raises(AutoReconnect):
+            await buffer.add({"id": 2}, wait=True)
+        assert len(buffer) == 1
+        collection.fail = None
+        assert await buffer.flush()
+    asyncio.run(scenario())
+    assert collection.written == [1]
+
+
+def test_cancelled_write_is_kept_with_its_waiters(collection):
+    async def scenario():
+        in_write = asyncio.Event()
+
+        async def hang(documents):
+            in_write.set()
+            await asyncio.Event().wait()
+        collection.fail = hang
+        
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=100)
+        await buffer.add({"id": 1})
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        buffer._pending.append(({"id": 2}, waiter))
+        flush = asyncio.create_task(buffer.flush())
+        await in_write.wait()
+        assert [document["id"] for document in buffer.pending(lambda document: True)] == [1, 2]
+        flush.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+        assert len(buffer) == 2 and not waiter.done()
+        
+        collection.fail = None
+        assert await buffer.flush()
+        await asyncio.wait_for(waiter, 1)
+    asyncio.run(scenario())
+    assert collection.written == [1, 2]
+
+
+def test_duplicate_key_on_retry_counts_as_written(collection):
+    async def already_written(documents):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}]})
+    collection.fail = already_written
+
+    async def scenario():
+        buffer = WriteBehindBuffer("test", batch_size=100, interval=60, max_pending=100)
+        await buffer.add({"id": 1}, wait=True)
+    asyncio.run(scenario())
+
+
+def test_buffered_prescriptions_can_be_listed_and_updated(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    httpx = pytest.importorskip("httpx")
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient()["test_pharmacy_platform"])
+    writer = WriteBehindBuffer("prescriptions", batch_size=100, interval=60, max_pending=100)
+    monkeypatch.setattr(server, "prescription_writer", writer)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as api:
+            submitted = await api.post("/api/prescriptions", json={"user_id": "u1", "pharmacy_id": "p1", "medications": []})
+            prescription_id = submitted.json()["prescription_id"]
+            assert len(writer) == 1
+            
+            listed = await api.get("/api/prescriptions/u1")
+            assert [prescription["id"] for prescription in listed.json()] == [prescription_id]
+            assert (await api.get("/api/prescriptions/u2")).json() == []
+            
+            updated = await api.post("/api/pharmacies/p1/prescriptions/status", json={
+                "prescription_ids": [prescription_id], "status": "ready"
+            })
+            assert updated.json() == {"updated": 1, "skipped": 0}
+            assert len(writer) == 0
+            listed = await api.get("/api/prescriptions/u1")
+            assert [prescription["status"] for prescription in listed.json()] == ["ready"]
+    asyncio.run(scenario())